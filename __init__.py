@@ -7,9 +7,11 @@
 __all__ = [
     "ns_app",
     "ns_archive",
+    "ns_cas",
     "ns_class",
     "ns_codec",
     "ns_common",
+    "ns_concurrent",
     "ns_console",
     "ns_constant",
     "ns_datetime",
@@ -3,18 +3,40 @@
 # @Time: 2021/6/29
 # @Author: Neil Steven
 
+import asyncio
+import bisect
 import bz2
+import copy
+import fnmatch
+import functools
 import gzip
+import io
+import itertools
+import json
 import lzma
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
 import tarfile
+import tempfile
+import threading
+import time
 import zipfile
+import zlib
+from concurrent.futures import Executor, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, BinaryIO, Callable, Iterator, NamedTuple, Union, Dict, Iterable, TypeVar, \
+    AsyncIterator
 
 from ns_common import is_empty
-from ns_file import delete
+from ns_concurrent import bounded_map
+from ns_file import delete, hash_file
 from ns_path import AnyPathLike, MultiPathLike, get_suffix, to_path, to_multi_path
 from ns_regex import is_match
+from ns_unit import parse_humanized_file_size
 
 try:
     import py7zr
@@ -26,185 +48,423 @@ try:
 except ImportError:
     rarfile = None
 
+# zstd is in the standard library since Python 3.14, and the lib 'zstandard' is used on the older versions
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 __all__ = [
-    "compress", "make_zip", "make_7z", "make_tar", "make_gz", "make_bz2", "make_xz",
-    "decompress", "un_zip", "un_rar", "un_7z", "un_tar", "un_gz", "un_bz2", "un_xz"
+    "compress", "auto_compress", "choose_codec", "make_zip", "make_7z", "make_tar", "make_gz", "make_bz2", "make_xz",
+    "make_zst", "decompress", "un_zip", "un_rar", "un_7z", "un_tar", "un_gz", "un_bz2", "un_xz", "un_zst",
+    "async_compress", "async_decompress", "async_decompress_iter",
+    "Selector", "ArchiveMember", "open_archive", "ArchiveProgress"
 ]
 
+T = TypeVar("T")
+ProgressCallback = Callable[["ArchiveProgress"], None]
 
-def compress(src: MultiPathLike, dst: AnyPathLike, *, delete_src: bool = False) -> str:
+# The chunk size used to stream the gz/bz2/xz payload, so the memory usage does not grow with the file size
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+# The uncompressed size of each independently compressed block in the parallel gz/bz2/xz mode
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+# The uncompressed distance between two checkpoints of an indexed tar file
+DEFAULT_CHECKPOINT_INTERVAL = 16 * 1024 * 1024
+TAR_INDEX_VERSION = 2
+MANIFEST_VERSION = 1
+ZSTD_DEFAULT_LEVEL = 3
+# The candidates (codec, level) of choose_codec, and the size and count of the sample blocks it compresses
+DEFAULT_CODEC_CANDIDATES = [("gz", 1), ("gz", 6), ("gz", 9), ("bz2", 9), ("xz", 0), ("xz", 3), ("xz", 6)] + (
+    [("zst", 1), ("zst", 3), ("zst", 9), ("zst", 19)] if zstd is not None or zstandard is not None else [])
+CODEC_SAMPLE_SIZE = 256 * 1024
+CODEC_SAMPLE_COUNT = 4
+# The largest file which is read into memory and compressed by the workers of the pipelined zip compressor
+PIPELINE_MAX_ENTRY_SIZE = 64 * 1024 * 1024
+# The total size of the files held in memory by the entries in flight of the pipelined zip compressor (and their
+# compressed bytes are about the same at most), the limit of each entry is lowered to share it among more workers
+PIPELINE_MAX_BUFFER_SIZE = 256 * 1024 * 1024
+# The members of a 7z file read by open_archive are kept in memory up to this size, and in temporary files otherwise
+SEVEN_ZIP_SPOOL_SIZE = 16 * 1024 * 1024
+# The header id of the zip64 extended information in the extra field of a zip entry
+ZIP64_EXTRA_HEADER_ID = 0x0001
+# The number of operations which the async functions run at the same time in the shared executor
+ASYNC_MAX_OPERATIONS = min(4, os.cpu_count() or 1)
+
+_BLOCK_COMPRESSORS = {
+    "gz": lambda data, level: gzip.compress(data, 9 if level is None else level),
+    "bz2": lambda data, level: bz2.compress(data, 9 if level is None else level),
+    "xz": lambda data, level: lzma.compress(data, preset=level),
+    "zst": lambda data, level: _zstd_compress(data, level)
+}
+_codec_decisions = {}
+_async_executor = None
+_async_executor_lock = threading.Lock()
+
+
+def compress(src: MultiPathLike, dst: AnyPathLike, *, workers: int = 1,
+             progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> str:
     """
     The convenience way to compress files.
 
     Attention:
     1. Compress file with password is unsupported
     2. rar compression is unsupported
-    3. gz/bz2/xz only support compressing single file
+    3. gz/bz2/xz/zst only support compressing single file
+    4. workers only takes effect on zip/gz/bz2/xz/zst for now
+    5. progress is called with an ArchiveProgress after every member (and every chunk of gz/bz2/xz/zst)
+    6. zst needs the module 'compression.zstd' (Python 3.14+) or the lib 'zstandard'
     """
     suffixes = get_suffix(dst, full=True)
     if suffixes.endswith(".zip"):
-        return make_zip(src, dst, delete_src=delete_src)
+        return make_zip(src, dst, workers=workers, progress=progress, delete_src=delete_src)
     elif suffixes.endswith(".7z"):
-        return make_7z(src, dst, delete_src=delete_src)
-    elif is_match(r".*\.(tar\.(gz|xz|bz)|(t(gz|xz|bz|bz2|b2)))$", suffixes):
-        return make_tar(src, dst, delete_src=delete_src)
-    elif is_match(r".*\.(gz|bz2|xz)$", suffixes):
+        return make_7z(src, dst, progress=progress, delete_src=delete_src)
+    elif is_match(r".*\.(tar|tar\.(gz|xz|bz2|zst)|t(gz|xz|bz|bz2|b2|zst))$", suffixes):
+        return make_tar(src, dst, progress=progress, delete_src=delete_src)
+    elif is_match(r".*\.(gz|bz2|xz|zst)$", suffixes):
         if isinstance(src, list):
             if len(src) > 1:
-                raise ValueError("Compress more than one file to a gz/bz2/xz file is not supported!")
+                raise ValueError("Compress more than one file to a gz/bz2/xz/zst file is not supported!")
             src = src[0]
 
         if suffixes.endswith(".gz"):
-            return make_gz(src, dst, delete_src=delete_src)
+            return make_gz(src, dst, workers=workers, progress=progress, delete_src=delete_src)
         elif suffixes.endswith(".bz2"):
-            return make_bz2(src, dst, delete_src=delete_src)
+            return make_bz2(src, dst, workers=workers, progress=progress, delete_src=delete_src)
+        elif suffixes.endswith(".xz"):
+            return make_xz(src, dst, workers=workers, progress=progress, delete_src=delete_src)
         else:
-            return make_xz(src, dst, delete_src=delete_src)
+            return make_zst(src, dst, workers=workers, progress=progress, delete_src=delete_src)
     else:
         raise ValueError(f"File type '{suffixes}' is not supported for compressing!")
 
 
-def make_zip(src: MultiPathLike, dst: AnyPathLike, *, store_only: bool = False, delete_src: bool = False) -> str:
+def auto_compress(src: AnyPathLike, dst: AnyPathLike, *, min_throughput: Optional[Union[int, str]] = None,
+                  max_seconds: Optional[float] = None, workers: int = 1,
+                  progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> str:
+    """
+    Compress a single file with the codec and level chosen by choose_codec,
+    and the suffix of the codec is appended to the destination path, e.g. 'dump.sql' -> 'dump.sql.xz'.
+    """
+    codec, level = choose_codec(src, min_throughput=min_throughput, max_seconds=max_seconds, workers=workers)
+    dst_path = to_path(dst)
+    dst_path = dst_path.with_name(f"{dst_path.name}.{codec}")
+    make_single_file = {"gz": make_gz, "bz2": make_bz2, "xz": make_xz, "zst": make_zst}[codec]
+    return make_single_file(src, dst_path, level=level, workers=workers, progress=progress, delete_src=delete_src)
+
+
+def choose_codec(src: AnyPathLike, *, min_throughput: Optional[Union[int, str]] = None,
+                 max_seconds: Optional[float] = None, workers: int = 1,
+                 candidates: Optional[List[Tuple[str, int]]] = None) -> Tuple[str, int]:
+    """
+    Choose the (codec, level) with the best ratio, which meets the throughput (bytes per second, or a readable
+    string like "200 MB") and the latency budget (seconds for the whole file) at the same time.
+    It compresses a few sample blocks of the file with every candidate, and the fastest one is chosen
+    if none of them meets the budget. The decision is remembered for the similar inputs, which have the same
+    suffix, the same magnitude of size and the same budget.
+    An empty file has nothing to sample and meets any budget, so it simply gets the first candidate.
+    """
+    src_path = to_path(src)
+    if not src_path.is_file():
+        raise IOError(f"Source file {src_path.name} does not exist!")
+    if isinstance(min_throughput, str):
+        min_throughput = parse_humanized_file_size(min_throughput)
+
+    file_size = src_path.stat().st_size
+    decision_key = (get_suffix(src_path, full=False).lower(), file_size.bit_length(),
+                    min_throughput, max_seconds, workers, tuple(candidates or DEFAULT_CODEC_CANDIDATES))
+    if decision_key in _codec_decisions:
+        return _codec_decisions[decision_key]
+
+    samples = _read_samples(src_path, file_size) if file_size > 0 else []
+    sample_size = sum(len(sample) for sample in samples)
+    if sample_size == 0:
+        # The file is empty (or truncated after the stat), the throughput of 0 cannot be measured
+        return (candidates or DEFAULT_CODEC_CANDIDATES)[0]
+    results = []
+    for codec, level in candidates or DEFAULT_CODEC_CANDIDATES:
+        start_time = time.perf_counter()
+        compressed_size = sum(len(_BLOCK_COMPRESSORS[codec](sample, level)) for sample in samples)
+        elapsed = max(time.perf_counter() - start_time, 1e-9)
+        # The blocks are compressed independently in the parallel mode, so the throughput scales with the workers
+        throughput = sample_size / elapsed * workers
+        results.append((codec, level, compressed_size / max(sample_size, 1), throughput))
+
+    qualified = [result for result in results
+                 if (min_throughput is None or result[3] >= min_throughput)
+                 and (max_seconds is None or file_size / result[3] <= max_seconds)]
+    if is_empty(qualified):
+        codec, level, _, _ = max(results, key=lambda result: result[3])
+    else:
+        codec, level, _, _ = min(qualified, key=lambda result: result[2])
+    _codec_decisions[decision_key] = (codec, level)
+    return codec, level
+
+
+def make_zip(src: MultiPathLike, dst: AnyPathLike, *, store_only: bool = False, recursive: bool = False,
+             workers: int = 1, incremental: bool = False, progress: Optional[ProgressCallback] = None,
+             delete_src: bool = False) -> str:
+    """
+    If recursive is True, the files under the source directories are added too.
+
+    If workers is more than 1, the files are read and compressed on a thread pool while the entries which are
+    already compressed are appended to the zip file one by one.
+
+    If incremental is True, a manifest ('<dst>.manifest.json') of the source files is kept next to the zip file.
+    The next run only compresses the new and changed files, the compressed bytes of unchanged entries are copied
+    from the previous zip file as they are, and the zip file is not touched at all if nothing is changed.
+    """
     src_path_list, dst_path = _compress_check(src, dst)
     zip_mode = zipfile.ZIP_STORED if store_only else zipfile.ZIP_DEFLATED
-    with zipfile.ZipFile(dst, "w", zip_mode) as zip_file:
-        for each in src_path_list:
-            zip_file.write(each)
+    tracker = _get_tracker("make_zip", progress)
+    if incremental:
+        _make_zip_incremental(list(_walk_paths(src_path_list, recursive)), dst_path, zip_mode, tracker)
+    elif workers > 1:
+        _make_zip_pipelined(_walk_paths(src_path_list, recursive), dst_path, zip_mode, workers, tracker)
+    else:
+        with zipfile.ZipFile(dst, "w", zip_mode) as zip_file:
+            for each in _walk_paths(src_path_list, recursive):
+                zip_file.write(each)
+                _track_zip_write(tracker, zip_file)
 
-        if delete_src:
-            for each in src_path_list:
-                delete(each)
-        return str(dst_path.resolve())
+    if delete_src:
+        for each in src_path_list:
+            delete(each)
+    return str(dst_path.resolve())
 
 
-def make_7z(src: MultiPathLike, dst: AnyPathLike, *, delete_src: bool = False) -> str:
-    # Attention: the python lib 'py7zr' is needed.
+def make_7z(src: MultiPathLike, dst: AnyPathLike, *, progress: Optional[ProgressCallback] = None,
+            delete_src: bool = False) -> str:
+    # Attention: the python lib 'py7zr' is needed, and the written bytes are only known after the file is closed.
     if py7zr is None:
         raise RuntimeError("The lib 'py7zr' is needed for the make_7z operation!")
 
     src_path_list, dst_path = _compress_check(src, dst)
+    tracker = _get_tracker("make_7z", progress)
     with py7zr.SevenZipFile(dst, "w") as seven_zip_file:
         for each in src_path_list:
             seven_zip_file.write(each)
+            if tracker is not None:
+                tracker.update(str(each), bytes_read=each.stat().st_size if each.is_file() else 0)
+    if tracker is not None:
+        tracker.update(bytes_written=dst_path.stat().st_size)
 
-        if delete_src:
-            for each in src_path_list:
-                delete(each)
-        return str(dst_path.resolve())
+    if delete_src:
+        for each in src_path_list:
+            delete(each)
+    return str(dst_path.resolve())
 
 
 def make_tar(src: MultiPathLike, dst: AnyPathLike, compression: Optional[str] = None, *,
+             index: bool = False, incremental: bool = False, progress: Optional[ProgressCallback] = None,
              delete_src: bool = False) -> str:
+    """
+    If index is True, the compressed stream is restarted every DEFAULT_CHECKPOINT_INTERVAL bytes and
+    an index sidecar ('<dst>.idx') is written, so that un_tar can extract members without a full scan.
+
+    If incremental is True, a manifest ('<dst>.manifest.json') of the source files is kept next to the tar file.
+    The tar file is not touched if nothing is changed, and the new files are appended to an uncompressed tar file
+    which has no index. Otherwise the tar file is rebuilt.
+    """
     src_path_list, dst_path = _compress_check(src, dst)
-    with tarfile.open(dst, _get_tar_mode(dst_path, "w", compression)) as tar_file:
+    tar_mode = _get_tar_mode(dst_path, "w", compression)
+    tracker = _get_tracker("make_tar", progress)
+    if incremental:
+        _make_tar_incremental(src_path_list, dst_path, tar_mode, index, tracker)
+    elif index:
+        _make_indexed_tar(src_path_list, dst_path, tar_mode.split(":")[1], tracker)
+    else:
+        with open(dst_path, "wb") as raw_file, _TrackedTarFile.open(
+                fileobj=_count_bytes(raw_file, tracker), mode=tar_mode, tracker=tracker) as tar_file:
+            for each in src_path_list:
+                tar_file.add(each)
+    # The compressor flushes the last bytes only when the tar file is closed
+    _track(tracker)
+
+    if delete_src:
         for each in src_path_list:
-            tar_file.add(each)
+            delete(each)
+    return str(dst_path.resolve())
+
+
+def make_gz(src: AnyPathLike, dst: AnyPathLike, *, level: Optional[int] = None,
+            buffer_size: int = DEFAULT_BUFFER_SIZE, workers: int = 1, block_size: int = DEFAULT_BLOCK_SIZE,
+            progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> str:
+    src_path_list, dst_path = _compress_check(src, dst)
+    level = 9 if level is None else level
+    tracker = _get_tracker("make_gz", progress)
+    with open(src_path_list[0], "rb") as input_file, open(dst, "wb") as output_file:
+        input_file = _count_bytes(input_file, tracker)
+        if workers > 1:
+            compress_block = functools.partial(_BLOCK_COMPRESSORS["gz"], level=level)
+            _parallel_compress(input_file, _count_bytes(output_file, tracker), compress_block, workers, block_size,
+                               tracker)
+        else:
+            with gzip.GzipFile(fileobj=_count_bytes(output_file, tracker), mode="w", compresslevel=level) as gz_file:
+                _copy_stream(input_file, gz_file, buffer_size, tracker)
+        _track(tracker, src_path_list[0].name)
 
         if delete_src:
-            for each in src_path_list:
-                delete(each)
+            delete(src)
         return str(dst_path.resolve())
 
 
-def make_gz(src: AnyPathLike, dst: AnyPathLike, *, delete_src: bool = False) -> str:
+def make_bz2(src: AnyPathLike, dst: AnyPathLike, *, level: Optional[int] = None,
+             buffer_size: int = DEFAULT_BUFFER_SIZE, workers: int = 1, block_size: int = DEFAULT_BLOCK_SIZE,
+             progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> str:
     src_path_list, dst_path = _compress_check(src, dst)
-    with open(src_path_list[0], "rb") as input_file:
-        with gzip.GzipFile(dst, "w") as gz_file:
-            gz_file.write(input_file.read())
+    level = 9 if level is None else level
+    tracker = _get_tracker("make_bz2", progress)
+    with open(src_path_list[0], "rb") as input_file, open(dst, "wb") as output_file:
+        input_file = _count_bytes(input_file, tracker)
+        if workers > 1:
+            compress_block = functools.partial(_BLOCK_COMPRESSORS["bz2"], level=level)
+            _parallel_compress(input_file, _count_bytes(output_file, tracker), compress_block, workers, block_size,
+                               tracker)
+        else:
+            with bz2.BZ2File(_count_bytes(output_file, tracker), "w", compresslevel=level) as bz_file:
+                _copy_stream(input_file, bz_file, buffer_size, tracker)
+        _track(tracker, src_path_list[0].name)
 
         if delete_src:
             delete(src)
         return str(dst_path.resolve())
 
 
-def make_bz2(src: AnyPathLike, dst: AnyPathLike, *, delete_src: bool = False) -> str:
+def make_xz(src: AnyPathLike, dst: AnyPathLike, *, level: Optional[int] = None,
+            buffer_size: int = DEFAULT_BUFFER_SIZE, workers: int = 1, block_size: int = DEFAULT_BLOCK_SIZE,
+            progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> str:
     src_path_list, dst_path = _compress_check(src, dst)
-    with open(src_path_list[0], "rb") as input_file:
-        with bz2.BZ2File(dst, "w") as bz_file:
-            bz_file.write(input_file.read())
+    tracker = _get_tracker("make_xz", progress)
+    with open(src_path_list[0], "rb") as input_file, open(dst, "wb") as output_file:
+        input_file = _count_bytes(input_file, tracker)
+        if workers > 1:
+            compress_block = functools.partial(_BLOCK_COMPRESSORS["xz"], level=level)
+            _parallel_compress(input_file, _count_bytes(output_file, tracker), compress_block, workers, block_size,
+                               tracker)
+        else:
+            with lzma.LZMAFile(_count_bytes(output_file, tracker), "w", preset=level) as xz_file:
+                _copy_stream(input_file, xz_file, buffer_size, tracker)
+        _track(tracker, src_path_list[0].name)
 
         if delete_src:
             delete(src)
         return str(dst_path.resolve())
 
 
-def make_xz(src: AnyPathLike, dst: AnyPathLike, *, delete_src: bool = False) -> str:
+def make_zst(src: AnyPathLike, dst: AnyPathLike, *, level: Optional[int] = None,
+             buffer_size: int = DEFAULT_BUFFER_SIZE, workers: int = 1,
+             progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> str:
+    """
+    Attention: the module 'compression.zstd' (Python 3.14+) or the lib 'zstandard' is needed.
+    If workers is more than 1, the compression runs on the worker threads of zstd itself,
+    so the output is still a single frame.
+    """
+    _check_zstd("make_zst")
     src_path_list, dst_path = _compress_check(src, dst)
-    with open(src_path_list[0], "rb") as input_file:
-        with lzma.LZMAFile(dst, "w") as xz_file:
-            xz_file.write(input_file.read())
+    tracker = _get_tracker("make_zst", progress)
+    with open(src_path_list[0], "rb") as input_file, open(dst, "wb") as output_file:
+        with _open_zstd(_count_bytes(output_file, tracker), "w", level, workers) as zst_file:
+            _copy_stream(_count_bytes(input_file, tracker), zst_file, buffer_size, tracker)
+        _track(tracker, src_path_list[0].name)
 
         if delete_src:
             delete(src)
         return str(dst_path.resolve())
 
 
-def decompress(src: AnyPathLike, dst_dir: AnyPathLike, *,
-               pattern: Optional[str] = None, password: Optional[str] = None, delete_src: bool = False) -> List[str]:
+def decompress(src: AnyPathLike, dst_dir: AnyPathLike, *, pattern: Optional[str] = None,
+               select: Optional["Selector"] = None, password: Optional[str] = None, workers: int = 1,
+               progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> List[str]:
     """
     The convenience way to decompress a file.
 
     Attention:
         1. Only zip/rar/7z support being decompressed with password
-        2. gz file does not support specifying pattern
+        2. gz file does not support specifying pattern or select
+        3. workers only takes effect on zip/7z for now
+        4. pattern is the shortcut of 'select=Selector(include=[pattern])', they cannot be specified together
+        5. progress is called with an ArchiveProgress after every member (and every chunk of gz/bz2/xz/zst)
+        6. zst needs the module 'compression.zstd' (Python 3.14+) or the lib 'zstandard'
     """
     suffixes = get_suffix(src, full=True)
     if suffixes.endswith(".zip"):
-        return un_zip(src, dst_dir, pattern=pattern, password=password, delete_src=delete_src)
+        return un_zip(src, dst_dir, pattern=pattern, select=select, password=password, workers=workers,
+                      progress=progress, delete_src=delete_src)
     elif suffixes.endswith(".rar"):
-        return un_rar(src, dst_dir, pattern=pattern, password=password, delete_src=delete_src)
+        return un_rar(src, dst_dir, pattern=pattern, select=select, password=password, progress=progress,
+                      delete_src=delete_src)
     elif suffixes.endswith(".7z"):
-        return un_7z(src, dst_dir, pattern=pattern, password=password, delete_src=delete_src)
-    elif is_match(r".*\.(tar\.(gz|xz|bz)|(t(gz|xz|bz|bz2|b2)))$", suffixes):
+        return un_7z(src, dst_dir, pattern=pattern, select=select, password=password, workers=workers,
+                     progress=progress, delete_src=delete_src)
+    elif is_match(r".*\.(tar|tar\.(gz|xz|bz2|zst)|t(gz|xz|bz|bz2|b2|zst))$", suffixes):
         if password is not None:
             raise ValueError("Tar file does not support being decompressed with password!")
-        return un_tar(src, dst_dir, pattern=pattern, compression=None, delete_src=delete_src)
-    elif is_match(r".*\.(gz|bz2|xz)$", suffixes):
-        if pattern is not None:
-            raise ValueError("Specify pattern to a gz/bz2/xz file is not supported!")
+        return un_tar(src, dst_dir, pattern=pattern, select=select, compression=None, progress=progress,
+                      delete_src=delete_src)
+    elif is_match(r".*\.(gz|bz2|xz|zst)$", suffixes):
+        if pattern is not None or select is not None:
+            raise ValueError("Specify pattern or select to a gz/bz2/xz/zst file is not supported!")
         if password is not None:
-            raise ValueError("gz/bz2/xz file does not support being decompressed with password!")
+            raise ValueError("gz/bz2/xz/zst file does not support being decompressed with password!")
 
         if suffixes.endswith(".gz"):
-            return [un_gz(src, dst_dir, delete_src=delete_src)]
+            return [un_gz(src, dst_dir, progress=progress, delete_src=delete_src)]
         elif suffixes.endswith(".bz2"):
-            return [un_bz2(src, dst_dir, delete_src=delete_src)]
+            return [un_bz2(src, dst_dir, progress=progress, delete_src=delete_src)]
+        elif suffixes.endswith(".xz"):
+            return [un_xz(src, dst_dir, progress=progress, delete_src=delete_src)]
         else:
-            return [un_xz(src, dst_dir, delete_src=delete_src)]
+            return [un_zst(src, dst_dir, progress=progress, delete_src=delete_src)]
     else:
         raise ValueError(f"File type '{suffixes}' is not supported for decompressing!")
 
 
-def un_zip(src: AnyPathLike, dst_dir: AnyPathLike, *,
-           pattern: Optional[str] = None, password: Optional[str] = None, delete_src: bool = False) -> List[str]:
+def un_zip(src: AnyPathLike, dst_dir: AnyPathLike, *, pattern: Optional[str] = None,
+           select: Optional["Selector"] = None, password: Optional[str] = None, workers: int = 1,
+           progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> List[str]:
     src_path, dst_dir_path = _decompress_check(src, dst_dir)
+    selector = _get_selector(pattern, select)
+    pwd = password.encode() if password is not None else None
+    tracker = _get_tracker("un_zip", progress)
     with zipfile.ZipFile(src_path, "r") as zip_file:
-        if pattern is None:
+        if selector is None:
             matched_inner_files = zip_file.namelist()
         else:
-            matched_inner_files = [inner_file for inner_file in zip_file.namelist()
-                                   if is_match(pattern, inner_file)]
-            zip_file.extractall(dst_dir, matched_inner_files, password)
+            matched_inner_files = [info.filename for info in selector.filter(
+                zip_file.infolist(), lambda info: info.filename, lambda info: info.file_size, _get_zip_mtime)]
+        if workers > 1:
+            _parallel_un_zip(src_path, dst_dir_path, matched_inner_files, pwd, workers, zip_file, tracker)
+        else:
+            zip_file.extractall(dst_dir, _track_unzipped(tracker, zip_file, matched_inner_files), pwd)
         if delete_src:
             delete(src_path)
         return [str(dst_dir_path.resolve() / inner_file) for inner_file in matched_inner_files]
 
 
-def un_rar(src: AnyPathLike, dst_dir: AnyPathLike, *,
-           pattern: Optional[str] = None, password: Optional[str] = None, delete_src: bool = False) -> List[str]:
+def un_rar(src: AnyPathLike, dst_dir: AnyPathLike, *, pattern: Optional[str] = None,
+           select: Optional["Selector"] = None, password: Optional[str] = None,
+           progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> List[str]:
     # Attention: the python lib 'rarfile' and UnRAR command line tool are both needed.
     if rarfile is None:
         raise RuntimeError("The lib 'rarfile' is needed for the un_rar operation!")
 
     src_path, dst_dir_path = _decompress_check(src, dst_dir)
+    selector = _get_selector(pattern, select)
+    tracker = _get_tracker("un_rar", progress)
     with rarfile.RarFile(src_path, "r") as rar_file:
         try:
-            if pattern is None:
+            if selector is None:
                 matched_inner_files = rar_file.namelist()
             else:
-                matched_inner_files = [inner_file for inner_file in rar_file.namelist()
-                                       if is_match(pattern, inner_file)]
-                rar_file.extractall(dst_dir, matched_inner_files, password)
+                matched_inner_files = [info.filename for info in selector.filter(
+                    rar_file.infolist(), lambda info: info.filename, lambda info: info.file_size, _get_zip_mtime)]
+            rar_file.extractall(dst_dir, _track_unzipped(tracker, rar_file, matched_inner_files), password)
         except rarfile.RarCannotExec:
             raise FileNotFoundError("Cannot find the UnRAR command line tool!")
         else:
@@ -214,75 +474,1345 @@ def un_rar(src: AnyPathLike, dst_dir: AnyPathLike, *,
 
 
 def un_7z(src: AnyPathLike, dst_dir: AnyPathLike, *, pattern: Optional[str] = None,
-          password: Optional[str] = None, delete_src: bool = False) -> List[str]:
-    # Attention: the python lib 'py7zr' is needed.
+          select: Optional["Selector"] = None, password: Optional[str] = None, workers: int = 1,
+          progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> List[str]:
+    # Attention: the python lib 'py7zr' is needed, and the members are reported after each batch is extracted.
     if py7zr is None:
         raise RuntimeError("The lib 'py7zr' is needed for the un_7z operation!")
 
     src_path, dst_dir_path = _decompress_check(src, dst_dir)
+    selector = _get_selector(pattern, select)
+    tracker = _get_tracker("un_7z", progress)
     with py7zr.SevenZipFile(src_path, "r", password=password) as seven_zip_file:
-        if pattern is None:
+        if selector is None:
             matched_inner_files = seven_zip_file.getnames()
         else:
-            matched_inner_files = [inner_file for inner_file in seven_zip_file.getnames()
-                                   if is_match(pattern, inner_file)]
-        seven_zip_file.extract(dst_dir, matched_inner_files)
+            matched_inner_files = [info.filename for info in selector.filter(
+                seven_zip_file.list(), lambda info: info.filename, lambda info: info.uncompressed, _get_7z_mtime)]
+        sizes = {info.filename: info.uncompressed or 0 for info in seven_zip_file.list()} if tracker else {}
+        blocks = _get_7z_blocks(seven_zip_file, matched_inner_files) if workers > 1 else []
+        if len(blocks) > 1:
+            _parallel_un_7z(src_path, dst_dir_path, blocks, password, workers, sizes, tracker)
+        else:
+            seven_zip_file.extract(dst_dir, matched_inner_files)
+            _track_un_7z(tracker, matched_inner_files, sizes)
+        if tracker is not None:
+            tracker.update(bytes_read=src_path.stat().st_size)
         if delete_src:
             delete(src_path)
         return [str(dst_dir_path.resolve() / inner_file) for inner_file in matched_inner_files]
 
 
-def un_tar(src: AnyPathLike, dst_dir: AnyPathLike, *, pattern: Optional[str] = None,
-           compression: Optional[str] = None, delete_src: bool = False) -> List[str]:
+def un_tar(src: Union[AnyPathLike, BinaryIO], dst_dir: AnyPathLike, *, pattern: Optional[str] = None,
+           select: Optional["Selector"] = None, compression: Optional[str] = None, index: bool = False,
+           stream: bool = False, progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> List[str]:
+    """
+    If index is True, the index sidecar ('<src>.idx') is used to seek to the matched members directly.
+    The sidecar is built (with one full scan) and saved when it is missing or out of date.
+
+    If stream is True, the tar file is read only once, and each member is extracted as soon as its header matches.
+    The src can also be a readable binary file object (e.g. stdin or a socket), which is always read as a stream.
+    """
+    selector = _get_selector(pattern, select)
+    tracker = _get_tracker("un_tar", progress)
+    if _is_file_object(src):
+        if index or delete_src:
+            raise ValueError("Index and delete_src are not supported when the source is a file object!")
+        dst_dir_path = _prepare_dst_dir(dst_dir)
+        matched_inner_files = _un_tar_stream(_count_bytes(src, tracker), dst_dir_path, selector, compression, tracker)
+        return [str(dst_dir_path.resolve() / inner_file) for inner_file in matched_inner_files]
+
     src_path, dst_dir_path = _decompress_check(src, dst_dir)
-    with tarfile.open(src_path, _get_tar_mode(src_path, "r", compression)) as tar_file:
-        if pattern is None:
-            matched_inner_members = tar_file.getmembers()
-        else:
-            matched_inner_members = [member for member in tar_file.getmembers()
-                                     if is_match(pattern, member.name)]
-        tar_file.extractall(dst_dir, matched_inner_members)
-        if delete_src:
-            delete(src_path)
-        return [str(dst_dir_path.resolve() / inner_member.name) for inner_member in matched_inner_members]
+    if index:
+        tar_index = _load_tar_index(src_path)
+        if tar_index is None:
+            tar_index = _build_tar_index(src_path, _get_tar_mode(src_path, "r", compression).split(":")[1])
+        matched_inner_files = _un_tar_indexed(src_path, dst_dir_path, tar_index, selector, tracker)
+    elif stream or _get_tar_mode(src_path, "r", compression) == "r:zst":
+        # tarfile cannot read zst by itself, and the zst reader of the lib 'zstandard' cannot seek backward
+        with open(src_path, "rb") as raw_file:
+            compression = _get_tar_mode(src_path, "r", compression).split(":")[1]
+            matched_inner_files = _un_tar_stream(_count_bytes(raw_file, tracker), dst_dir_path, selector,
+                                                 compression, tracker)
+    else:
+        with open(src_path, "rb") as raw_file, tarfile.open(
+                fileobj=_count_bytes(raw_file, tracker), mode=_get_tar_mode(src_path, "r", compression)) as tar_file:
+            if selector is None:
+                matched_inner_members = tar_file.getmembers()
+            else:
+                matched_inner_members = selector.filter(tar_file.getmembers(), lambda member: member.name,
+                                                        lambda member: member.size, lambda member: member.mtime)
+            tar_file.extractall(dst_dir, _track_untarred(tracker, matched_inner_members))
+        matched_inner_files = [inner_member.name for inner_member in matched_inner_members]
+
+    if delete_src:
+        delete(src_path)
+    return [str(dst_dir_path.resolve() / inner_file) for inner_file in matched_inner_files]
 
 
-def un_gz(src: AnyPathLike, dst_dir: AnyPathLike, *, delete_src: bool = False) -> str:
+def un_gz(src: AnyPathLike, dst_dir: AnyPathLike, *, buffer_size: int = DEFAULT_BUFFER_SIZE,
+          progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> str:
     src_path, dst_dir_path = _decompress_check(src, dst_dir)
-    with gzip.GzipFile(src_path, "rb") as gz_file:
+    tracker = _get_tracker("un_gz", progress)
+    with open(src_path, "rb") as raw_file, gzip.GzipFile(fileobj=_count_bytes(raw_file, tracker), mode="rb") as gz_file:
         output_file_path = dst_dir_path / src_path.with_suffix("").name
         with open(output_file_path, "wb+") as output_file:
-            output_file.write(gz_file.read())
+            _copy_stream(gz_file, _count_bytes(output_file, tracker), buffer_size, tracker)
+        _track(tracker, output_file_path.name)
 
     if delete_src:
         delete(src_path)
     return str(output_file_path.resolve())
 
 
-def un_bz2(src: AnyPathLike, dst_dir: AnyPathLike, *, delete_src: bool = False) -> str:
+def un_bz2(src: AnyPathLike, dst_dir: AnyPathLike, *, buffer_size: int = DEFAULT_BUFFER_SIZE,
+           progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> str:
     src_path, dst_dir_path = _decompress_check(src, dst_dir)
-    with bz2.BZ2File(src_path, "rb") as bz_file:
+    tracker = _get_tracker("un_bz2", progress)
+    with open(src_path, "rb") as raw_file, bz2.BZ2File(_count_bytes(raw_file, tracker), "rb") as bz_file:
         output_file_path = dst_dir_path / src_path.with_suffix("").name
         with open(output_file_path, "wb+") as output_file:
-            output_file.write(bz_file.read())
+            _copy_stream(bz_file, _count_bytes(output_file, tracker), buffer_size, tracker)
+        _track(tracker, output_file_path.name)
 
     if delete_src:
         delete(src_path)
     return str(output_file_path.resolve())
 
 
-def un_xz(src: AnyPathLike, dst_dir: AnyPathLike, *, delete_src: bool = False) -> str:
+def un_xz(src: AnyPathLike, dst_dir: AnyPathLike, *, buffer_size: int = DEFAULT_BUFFER_SIZE,
+          progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> str:
     src_path, dst_dir_path = _decompress_check(src, dst_dir)
-    with lzma.LZMAFile(src_path, "rb") as xz_file:
+    tracker = _get_tracker("un_xz", progress)
+    with open(src_path, "rb") as raw_file, lzma.LZMAFile(_count_bytes(raw_file, tracker), "rb") as xz_file:
         output_file_path = dst_dir_path / src_path.with_suffix("").name
         with open(output_file_path, "wb+") as output_file:
-            output_file.write(xz_file.read())
+            _copy_stream(xz_file, _count_bytes(output_file, tracker), buffer_size, tracker)
+        _track(tracker, output_file_path.name)
 
     if delete_src:
         delete(src_path)
     return str(output_file_path.resolve())
 
 
+def un_zst(src: AnyPathLike, dst_dir: AnyPathLike, *, buffer_size: int = DEFAULT_BUFFER_SIZE,
+           progress: Optional[ProgressCallback] = None, delete_src: bool = False) -> str:
+    # Attention: the module 'compression.zstd' (Python 3.14+) or the lib 'zstandard' is needed.
+    _check_zstd("un_zst")
+    src_path, dst_dir_path = _decompress_check(src, dst_dir)
+    tracker = _get_tracker("un_zst", progress)
+    with open(src_path, "rb") as raw_file, _open_zstd(_count_bytes(raw_file, tracker), "r") as zst_file:
+        output_file_path = dst_dir_path / src_path.with_suffix("").name
+        with open(output_file_path, "wb+") as output_file:
+            _copy_stream(zst_file, _count_bytes(output_file, tracker), buffer_size, tracker)
+        _track(tracker, output_file_path.name)
+
+    if delete_src:
+        delete(src_path)
+    return str(output_file_path.resolve())
+
+
+async def async_compress(src: MultiPathLike, dst: AnyPathLike, *, workers: int = 1,
+                         progress: Optional[ProgressCallback] = None, executor: Optional[Executor] = None,
+                         delete_src: bool = False) -> str:
+    """
+    The asyncio version of compress, which runs in the executor (a shared pool of ASYNC_MAX_OPERATIONS threads
+    by default) without blocking the event loop.
+
+    Attention:
+        1. progress is called in the event loop thread
+        2. If the task is cancelled, the operation stops at the next member (or chunk of gz/bz2/xz),
+           and the unfinished destination file is deleted before the CancelledError is raised
+    """
+    def remove_unfinished():
+        dst_path = to_path(dst)
+        if dst_path.is_file():
+            delete(dst_path)
+
+    operation = functools.partial(compress, src, dst, workers=workers, delete_src=delete_src)
+    return await _run_async(operation, progress, executor, remove_unfinished)
+
+
+async def async_decompress(src: AnyPathLike, dst_dir: AnyPathLike, *, pattern: Optional[str] = None,
+                           select: Optional["Selector"] = None, password: Optional[str] = None, workers: int = 1,
+                           progress: Optional[ProgressCallback] = None, executor: Optional[Executor] = None,
+                           delete_src: bool = False) -> List[str]:
+    """
+    The asyncio version of decompress, see async_compress.
+    If the task is cancelled, the members which are already extracted are kept.
+    """
+    operation = functools.partial(decompress, src, dst_dir, pattern=pattern, select=select, password=password,
+                                  workers=workers, delete_src=delete_src)
+    return await _run_async(operation, progress, executor)
+
+
+async def async_decompress_iter(src: AnyPathLike, dst_dir: AnyPathLike, *, pattern: Optional[str] = None,
+                                select: Optional["Selector"] = None, password: Optional[str] = None,
+                                workers: int = 1, executor: Optional[Executor] = None,
+                                delete_src: bool = False) -> AsyncIterator["ArchiveProgress"]:
+    """
+    Decompress like async_decompress, and yield the ArchiveProgress of every member as soon as it is extracted.
+    The operation is cancelled if the iteration stops early, and its error is raised at the end of the iteration.
+    """
+    queue = asyncio.Queue()
+
+    def on_progress(event: ArchiveProgress):
+        if event.member is not None:
+            queue.put_nowait(event)
+
+    task = asyncio.ensure_future(async_decompress(src, dst_dir, pattern=pattern, select=select, password=password,
+                                                  workers=workers, progress=on_progress, executor=executor,
+                                                  delete_src=delete_src))
+    # The progress events are scheduled before the result, so the end mark is always the last item
+    task.add_done_callback(lambda _: queue.put_nowait(None))
+    try:
+        while (event := await queue.get()) is not None:
+            yield event
+        await task
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.wait([task])
+
+
+class Selector(object):
+    """
+    The member selection rules which are compiled once, and then shared by decompress and all the un_* functions.
+
+    A member is selected if it matches any of the include regexes / globs (or there is no include rule at all),
+    matches none of the exclude regexes / globs, and its size and mtime (timestamp) are within the limits.
+    Like 'ns_regex.is_match', a regex only needs to match the beginning of the member name,
+    and a glob needs to match the whole name. The sizes can also be readable strings, e.g. "10 MB".
+    """
+
+    def __init__(self, include: Optional[List[str]] = None, exclude: Optional[List[str]] = None, *,
+                 include_glob: Optional[List[str]] = None, exclude_glob: Optional[List[str]] = None,
+                 min_size: Optional[Union[int, str]] = None, max_size: Optional[Union[int, str]] = None,
+                 min_mtime: Optional[float] = None, max_mtime: Optional[float] = None):
+        self._include = self._compile(include, include_glob)
+        self._exclude = self._compile(exclude, exclude_glob)
+        self._min_size = parse_humanized_file_size(min_size) if isinstance(min_size, str) else min_size
+        self._max_size = parse_humanized_file_size(max_size) if isinstance(max_size, str) else max_size
+        self._min_mtime = min_mtime
+        self._max_mtime = max_mtime
+
+    @staticmethod
+    def _compile(regexes: Optional[List[str]], globs: Optional[List[str]]) -> Optional[Callable]:
+        # The translated globs only use scoped flags and no group, so they are merged into one regex and each name is
+        # matched only once, but the regexes are compiled separately to keep their global flags and backreferences
+        matchers = [re.compile(regex).match for regex in regexes or []]
+        if not is_empty(globs):
+            matchers.append(re.compile("|".join(fnmatch.translate(each) for each in globs)).match)
+        if is_empty(matchers):
+            return None
+        if len(matchers) == 1:
+            return matchers[0]
+        return lambda name: any(matcher(name) for matcher in matchers)
+
+    def matches(self, name: str, size: Optional[int] = None, mtime: Optional[float] = None) -> bool:
+        return len(self.filter([(name, size, mtime)], lambda member: member[0],
+                               lambda member: member[1], lambda member: member[2])) > 0
+
+    def filter(self, members: List[T], get_name: Callable[[T], str], get_size: Callable[[T], Optional[int]],
+               get_mtime: Callable[[T], Optional[float]]) -> List[T]:
+        """
+        Filter the members in order, the size / mtime is only got when there is a rule on it.
+        A member whose size / mtime is unknown (None) does not pass the rule on it.
+        """
+        if self._include is not None:
+            members = [member for member in members if self._include(get_name(member))]
+        if self._exclude is not None:
+            members = [member for member in members if not self._exclude(get_name(member))]
+        if self._min_size is not None or self._max_size is not None:
+            min_size = self._min_size if self._min_size is not None else 0
+            max_size = self._max_size if self._max_size is not None else math.inf
+            members = [member for member in members
+                       if (size := get_size(member)) is not None and min_size <= size <= max_size]
+        if self._min_mtime is not None or self._max_mtime is not None:
+            min_mtime = self._min_mtime if self._min_mtime is not None else -math.inf
+            max_mtime = self._max_mtime if self._max_mtime is not None else math.inf
+            members = [member for member in members
+                       if (mtime := get_mtime(member)) is not None and min_mtime <= mtime <= max_mtime]
+        return members
+
+
+class ArchiveMember(NamedTuple):
+    name: str
+    size: Optional[int]
+    mtime: Optional[float]
+    is_dir: bool
+
+
+class ArchiveProgress(NamedTuple):
+    """
+    The event passed to the progress callback of the compress / decompress operations.
+
+    Attention:
+        1. member is the name of the member which is just finished, and it is None for an intermediate report
+           (e.g. every chunk of a gz/bz2/xz file, or the bytes flushed when an archive is closed)
+        2. bytes_read and bytes_written are cumulative, the archive side counts the compressed bytes
+        3. member_seconds is the time spent since the previous member is finished
+    """
+    operation: str
+    member: Optional[str]
+    members_done: int
+    bytes_read: int
+    bytes_written: int
+    member_seconds: float
+    elapsed: float
+
+
+def open_archive(src: AnyPathLike, *,
+                 password: Optional[str] = None) -> Iterator[Tuple[ArchiveMember, Optional[BinaryIO]]]:
+    """
+    Iterate the members of an archive lazily without extracting them to disk.
+
+    Attention:
+        1. The stream of a member is only valid until the next member is yielded, and it is None for a directory
+        2. The stream of a stored (uncompressed) zip member is a zero-copy view over the mmap of the archive,
+           and its 'getbuffer' method returns the underlying memoryview
+        3. 7z members are all decoded by py7zr first, since the lib has no lazy reader, and each of them is kept in
+           memory up to SEVEN_ZIP_SPOOL_SIZE bytes and in a temporary file otherwise
+    """
+    src_path = to_path(src)
+    if not src_path.is_file():
+        raise IOError(f"Source file {src_path.name} does not exist!")
+
+    suffixes = get_suffix(src_path, full=True)
+    if suffixes.endswith(".zip"):
+        return _open_zip(src_path, password)
+    elif suffixes.endswith(".rar"):
+        return _open_rar(src_path, password)
+    elif suffixes.endswith(".7z"):
+        return _open_7z(src_path, password)
+    elif is_match(r".*\.(tar|tar\.(gz|xz|bz2|zst)|t(gz|xz|bz|bz2|b2|zst))$", suffixes):
+        if password is not None:
+            raise ValueError("Tar file does not support being opened with password!")
+        return _open_tar(src_path)
+    elif is_match(r".*\.(gz|bz2|xz|zst)$", suffixes):
+        if password is not None:
+            raise ValueError("gz/bz2/xz/zst file does not support being opened with password!")
+        return _open_single_file(src_path, suffixes)
+    else:
+        raise ValueError(f"File type '{suffixes}' is not supported for opening!")
+
+
+class _MemoryViewReader(io.RawIOBase):
+    """
+    The read-only file-like object over a memoryview, which does not copy the data until it is read.
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def getbuffer(self) -> memoryview:
+        return self._view
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._view) if size is None or size < 0 else min(len(self._view), self._position + size)
+        data = bytes(self._view[self._position:end])
+        self._position = max(self._position, end)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self._view[self._position:self._position + len(buffer)]
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+def _zip_stored_view(archive_map: mmap.mmap, info: zipfile.ZipInfo) -> memoryview:
+    # The data starts after the local file header, whose name and extra field may differ from the central directory
+    header_offset = info.header_offset
+    if archive_map[header_offset:header_offset + 4] != b"PK\x03\x04":
+        raise IOError(f"Bad local file header of member {info.filename}!")
+    name_length, extra_length = struct.unpack_from("<HH", archive_map, header_offset + 26)
+    data_offset = header_offset + 30 + name_length + extra_length
+    return memoryview(archive_map)[data_offset:data_offset + info.compress_size]
+
+
+def _open_zip(src_path: Path, password: Optional[str]) -> Iterator[Tuple[ArchiveMember, Optional[BinaryIO]]]:
+    pwd = password.encode() if password is not None else None
+    with open(src_path, "rb") as raw_file, zipfile.ZipFile(raw_file, "r") as zip_file:
+        archive_map = mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for info in zip_file.infolist():
+                member = ArchiveMember(info.filename, info.file_size, _get_zip_mtime(info), info.is_dir())
+                if info.is_dir():
+                    yield member, None
+                elif info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+                    yield member, _MemoryViewReader(_zip_stored_view(archive_map, info))
+                else:
+                    with zip_file.open(info, "r", pwd) as stream:
+                        yield member, stream
+        finally:
+            try:
+                archive_map.close()
+            except BufferError:
+                # The caller still holds some views, the map will be closed once they are released
+                pass
+
+
+def _open_rar(src_path: Path, password: Optional[str]) -> Iterator[Tuple[ArchiveMember, Optional[BinaryIO]]]:
+    # Attention: the python lib 'rarfile' and UnRAR command line tool are both needed.
+    if rarfile is None:
+        raise RuntimeError("The lib 'rarfile' is needed for the open_archive operation!")
+
+    with rarfile.RarFile(src_path, "r") as rar_file:
+        for info in rar_file.infolist():
+            member = ArchiveMember(info.filename, info.file_size, _get_zip_mtime(info), info.is_dir())
+            if info.is_dir():
+                yield member, None
+            else:
+                try:
+                    with rar_file.open(info, "r", password) as stream:
+                        yield member, stream
+                except rarfile.RarCannotExec:
+                    raise FileNotFoundError("Cannot find the UnRAR command line tool!")
+
+
+def _open_7z(src_path: Path, password: Optional[str]) -> Iterator[Tuple[ArchiveMember, Optional[BinaryIO]]]:
+    # Attention: the python lib 'py7zr' is needed.
+    if py7zr is None:
+        raise RuntimeError("The lib 'py7zr' is needed for the open_archive operation!")
+
+    if not hasattr(py7zr, "WriterFactory"):
+        raise RuntimeError("The lib 'py7zr' 1.0 or later is needed for the open_archive operation!")
+
+    # py7zr decompresses the members in one pass into the files created by the factory
+    factory = _Spooled7zFactory()
+    try:
+        with py7zr.SevenZipFile(src_path, "r", password=password) as seven_zip_file:
+            infos = seven_zip_file.list()
+            seven_zip_file.extractall(factory=factory)
+        for info in infos:
+            member = ArchiveMember(info.filename, info.uncompressed, _get_7z_mtime(info), info.is_directory)
+            spooled_file = factory.files.get(info.filename)
+            yield member, spooled_file.file if spooled_file is not None and not info.is_directory else None
+    finally:
+        factory.close()
+
+
+def _open_tar(src_path: Path) -> Iterator[Tuple[ArchiveMember, Optional[BinaryIO]]]:
+    # The stream mode reads the tar file only once
+    with open(src_path, "rb") as raw_file:
+        compression = _detect_compression(raw_file.read(6))
+        raw_file.seek(0)
+        with _open_codec_reader(raw_file, compression) as stream, tarfile.open(fileobj=stream, mode="r|") as tar_file:
+            for info in tar_file:
+                member = ArchiveMember(info.name, info.size, float(info.mtime), info.isdir())
+                if info.isfile():
+                    with tar_file.extractfile(info) as member_stream:
+                        yield member, member_stream
+                else:
+                    yield member, None
+
+
+def _open_single_file(src_path: Path, suffixes: str) -> Iterator[Tuple[ArchiveMember, Optional[BinaryIO]]]:
+    compression = suffixes.rsplit(".", 1)[1]
+    with open(src_path, "rb") as raw_file, _open_codec_reader(raw_file, compression) as stream:
+        yield ArchiveMember(src_path.with_suffix("").name, None, src_path.stat().st_mtime, False), stream
+
+
+class _ProgressTracker(object):
+    """
+    The counters of an operation, the callback is called with the lock held, so it is never called concurrently.
+    """
+
+    def __init__(self, operation: str, callback: ProgressCallback):
+        self._operation = operation
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._members_done = 0
+        self._bytes_read = 0
+        self._bytes_written = 0
+        self._start_time = self._member_start_time = time.perf_counter()
+
+    def count(self, bytes_read: int = 0, bytes_written: int = 0):
+        with self._lock:
+            self._bytes_read += bytes_read
+            self._bytes_written += bytes_written
+
+    def update(self, member: Optional[str] = None, bytes_read: int = 0, bytes_written: int = 0):
+        with self._lock:
+            now = time.perf_counter()
+            self._bytes_read += bytes_read
+            self._bytes_written += bytes_written
+            if member is not None:
+                self._members_done += 1
+            self._callback(ArchiveProgress(self._operation, member, self._members_done, self._bytes_read,
+                                           self._bytes_written, now - self._member_start_time, now - self._start_time))
+            if member is not None:
+                self._member_start_time = now
+
+
+class _Spooled7zFactory(object):
+    """
+    The writer factory of py7zr, which writes every member into a spooled temporary file.
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def create(self, filename: str) -> "_Spooled7zFile":
+        self.files[filename] = _Spooled7zFile()
+        return self.files[filename]
+
+    def close(self):
+        for each in self.files.values():
+            each.file.close()
+
+
+class _Spooled7zFile(object):
+    """
+    The writer of a member given to py7zr, py7zr rewinds and closes it after writing, but the data is kept until
+    the factory is closed.
+    """
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(SEVEN_ZIP_SPOOL_SIZE)
+
+    def write(self, data: bytes) -> int:
+        return self.file.write(data)
+
+    def read(self, size: Optional[int] = None) -> bytes:
+        return self.file.read(size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.file.seek(offset, whence)
+
+    def flush(self):
+        self.file.flush()
+
+    def size(self) -> int:
+        return self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        pass
+
+
+class _CountingFile(object):
+    """
+    The wrapper of a binary file which counts the bytes read from / written to it, the rest is delegated.
+    """
+
+    def __init__(self, file: BinaryIO, tracker: _ProgressTracker):
+        self._file = file
+        self._tracker = tracker
+
+    def __getattr__(self, name: str):
+        return getattr(self._file, name)
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._file.read(size)
+        self._tracker.count(bytes_read=len(data))
+        return data
+
+    def readinto(self, buffer) -> int:
+        size = self._file.readinto(buffer)
+        self._tracker.count(bytes_read=size or 0)
+        return size
+
+    def write(self, data) -> int:
+        size = self._file.write(data)
+        self._tracker.count(bytes_written=memoryview(data).nbytes)
+        return size
+
+
+def _get_tracker(operation: str, progress: Optional[ProgressCallback]) -> Optional[_ProgressTracker]:
+    # Without a callback there is no tracker at all, and every hook is skipped by a single None check
+    return _ProgressTracker(operation, progress) if progress is not None else None
+
+
+def _track(tracker: Optional[_ProgressTracker], member: Optional[str] = None, bytes_read: int = 0,
+           bytes_written: int = 0):
+    if tracker is not None:
+        tracker.update(member, bytes_read, bytes_written)
+
+
+def _count_bytes(file: BinaryIO, tracker: Optional[_ProgressTracker]) -> BinaryIO:
+    return _CountingFile(file, tracker) if tracker is not None else file
+
+
+def _copy_stream(input_file: BinaryIO, output_file: BinaryIO, buffer_size: int,
+                 tracker: Optional[_ProgressTracker]):
+    if tracker is None:
+        shutil.copyfileobj(input_file, output_file, buffer_size)
+        return
+    while chunk := input_file.read(buffer_size):
+        output_file.write(chunk)
+        tracker.update()
+
+
+def _track_zip_write(tracker: Optional[_ProgressTracker], zip_file: zipfile.ZipFile):
+    if tracker is not None:
+        info = zip_file.filelist[-1]
+        tracker.update(info.filename, bytes_read=info.file_size, bytes_written=info.compress_size)
+
+
+def _track_unzipped(tracker: Optional[_ProgressTracker], zip_file, inner_files: Iterable[str]) -> Iterable[str]:
+    # The extractall of zipfile / rarfile takes the next member only after the previous one is extracted
+    if tracker is None:
+        return inner_files
+    return _track_members(tracker, inner_files, lambda inner_file: (
+        inner_file, zip_file.getinfo(inner_file).compress_size, zip_file.getinfo(inner_file).file_size))
+
+
+def _track_untarred(tracker: Optional[_ProgressTracker],
+                    members: List[tarfile.TarInfo]) -> Iterable[tarfile.TarInfo]:
+    # The compressed bytes are counted by the file under the tar file
+    if tracker is None:
+        return members
+    return _track_members(tracker, members, lambda member: (member.name, 0, member.size))
+
+
+def _track_members(tracker: _ProgressTracker, members: Iterable[T],
+                   get_progress: Callable[[T], Tuple[str, int, int]]) -> Iterator[T]:
+    for member in members:
+        yield member
+        tracker.update(*get_progress(member))
+
+
+def _track_un_7z(tracker: Optional[_ProgressTracker], inner_files: List[str], sizes: Dict[str, int]):
+    if tracker is not None:
+        for inner_file in inner_files:
+            tracker.update(inner_file, bytes_written=sizes.get(inner_file, 0))
+
+
+class _OperationCancelled(Exception):
+    pass
+
+
+async def _run_async(operation: Callable, progress: Optional[ProgressCallback], executor: Optional[Executor],
+                     on_cancelled: Optional[Callable[[], None]] = None):
+    """
+    Run the operation in the executor, and pass the progress events back to the event loop.
+    A thread cannot be interrupted, so the cancellation is checked by the progress hook of the operation,
+    and on_cancelled is called in the executor if the operation is stopped halfway.
+    """
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+
+    def on_progress(event: ArchiveProgress):
+        if cancelled.is_set():
+            raise _OperationCancelled()
+        if progress is not None:
+            loop.call_soon_threadsafe(progress, event)
+
+    def run():
+        # The operation may be cancelled while it is still waiting for a free thread
+        if cancelled.is_set():
+            raise _OperationCancelled()
+        try:
+            return operation(progress=on_progress)
+        except _OperationCancelled:
+            if on_cancelled is not None:
+                on_cancelled()
+            raise
+
+    future = loop.run_in_executor(executor or _get_async_executor(), run)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # Wait for the operation to stop, so that the files are no longer touched after the task is cancelled
+        cancelled.set()
+        await asyncio.wait([future])
+        if not future.cancelled():
+            future.exception()
+        raise
+
+
+def _get_async_executor() -> Executor:
+    global _async_executor
+    with _async_executor_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(ASYNC_MAX_OPERATIONS, thread_name_prefix="ns_archive")
+        return _async_executor
+
+
+def _get_selector(pattern: Optional[str], select: Optional[Selector]) -> Optional[Selector]:
+    if pattern is not None and select is not None:
+        raise ValueError("The pattern and select cannot be specified together!")
+    return Selector(include=[pattern]) if pattern is not None else select
+
+
+def _get_zip_mtime(info) -> float:
+    # Both the ZipInfo and RarInfo store the local time as a tuple
+    return time.mktime(tuple(info.date_time) + (0, 0, -1))
+
+
+def _get_7z_mtime(info) -> Optional[float]:
+    return info.creationtime.timestamp() if info.creationtime is not None else None
+
+
+def _read_samples(src_path: Path, file_size: int) -> List[bytes]:
+    # The samples are spread evenly over the file, since the head is often not representative (e.g. headers)
+    sample_count = max(1, min(CODEC_SAMPLE_COUNT, file_size // CODEC_SAMPLE_SIZE))
+    step = max(0, file_size - CODEC_SAMPLE_SIZE) // max(1, sample_count - 1)
+    samples = []
+    with open(src_path, "rb") as input_file:
+        for i in range(sample_count):
+            input_file.seek(i * step)
+            samples.append(input_file.read(CODEC_SAMPLE_SIZE))
+    return samples
+
+
+def _parallel_compress(input_file: BinaryIO, output_file: BinaryIO, compress_block: Callable[[bytes], bytes],
+                       workers: int, block_size: int, tracker: Optional[_ProgressTracker] = None):
+    """
+    Split the input into blocks and compress them on a thread pool (zlib/bz2/lzma all release the GIL).
+    Each block becomes a complete gz member / bz2 stream / xz stream, and the concatenation of them is still
+    a standard file which can be decompressed by the stock tools.
+    """
+    blocks = iter(functools.partial(input_file.read, block_size), b"")
+    for compressed_block in bounded_map(compress_block, blocks, workers):
+        output_file.write(compressed_block)
+        _track(tracker)
+
+
+def _parallel_un_zip(src_path: Path, dst_dir_path: Path, inner_files: List[str], pwd: Optional[bytes], workers: int,
+                     zip_file: zipfile.ZipFile, tracker: Optional[_ProgressTracker]):
+    # The reads on a shared ZipFile are serialized by its lock, so every thread opens its own handle
+    thread_local = threading.local()
+    zip_files = []
+
+    def extract(inner_file: str) -> str:
+        if not hasattr(thread_local, "zip_file"):
+            thread_local.zip_file = zipfile.ZipFile(src_path, "r")
+            zip_files.append(thread_local.zip_file)
+        thread_local.zip_file.extract(inner_file, dst_dir_path, pwd)
+        return inner_file
+
+    # Create the directories up front, otherwise the threads race on creating the same parent directory
+    for inner_file in inner_files:
+        target_path = _get_zip_target_path(dst_dir_path, inner_file)
+        inner_dir = target_path if inner_file.endswith("/") else target_path.parent
+        inner_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        # The members are reported in order by the calling thread
+        for _ in _track_unzipped(tracker, zip_file, bounded_map(extract, inner_files, workers)):
+            pass
+    finally:
+        for each in zip_files:
+            each.close()
+
+
+def _get_zip_target_path(dst_dir_path: Path, inner_file: str) -> Path:
+    # The same sanitizing as ZipFile.extract, the absolute paths, drives and '..' are dropped from the member name
+    arcname = inner_file.replace("/", os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    arcname = os.path.sep.join(part for part in arcname.split(os.path.sep) if part not in ("", os.curdir, os.pardir))
+    if os.path.sep == "\\":
+        arcname = zipfile.ZipFile._sanitize_windows_name(arcname, os.path.sep)
+    return dst_dir_path / arcname
+
+
+def _get_7z_blocks(seven_zip_file, inner_files: List[str]) -> List[List[str]]:
+    # The members of a block (folder) are compressed as one stream, so a member can only be decompressed from the
+    # start of its block. A solid archive has only one block, and is extracted serially
+    matched_files = set(inner_files)
+    blocks = {}
+    for file_info in seven_zip_file.files:
+        if file_info.filename in matched_files:
+            blocks.setdefault(id(file_info.folder), []).append(file_info.filename)
+    return list(blocks.values())
+
+
+def _parallel_un_7z(src_path: Path, dst_dir_path: Path, blocks: List[List[str]], password: Optional[str],
+                    workers: int, sizes: Dict[str, int], tracker: Optional[_ProgressTracker]):
+    # Every thread extracts a contiguous slice of the blocks with its own handle, and a block is never split
+    slice_size = max(1, -(-len(blocks) // workers))
+    slices = [list(itertools.chain.from_iterable(blocks[i:i + slice_size]))
+              for i in range(0, len(blocks), slice_size)]
+
+    def extract(targets: List[str]) -> List[str]:
+        with py7zr.SevenZipFile(src_path, "r", password=password) as seven_zip_file:
+            seven_zip_file.extract(dst_dir_path, targets)
+        return targets
+
+    for targets in bounded_map(extract, slices, workers):
+        _track_un_7z(tracker, targets, sizes)
+
+
+class _CheckpointWriter(object):
+    """
+    The file-like object which compresses the written data, and restarts the compressed stream (a new gz member /
+    bz2 stream / xz stream) every 'interval' bytes. The start of each stream is a checkpoint, which is recorded as
+    (compressed offset, uncompressed offset) and where a decompressor can start from scratch.
+    """
+
+    _COMPRESSOR_FACTORIES = {
+        "": None,
+        "gz": lambda: zlib.compressobj(9, zlib.DEFLATED, 31),
+        "bz2": lambda: bz2.BZ2Compressor(),
+        "xz": lambda: lzma.LZMACompressor(),
+        "zst": lambda: _new_zstd_compressor(None)
+    }
+
+    def __init__(self, raw_file: BinaryIO, compression: str, interval: int):
+        if compression not in self._COMPRESSOR_FACTORIES:
+            raise ValueError(f"Compression '{compression}' does not support the tar index!")
+        self._raw_file = raw_file
+        self._new_compressor = self._COMPRESSOR_FACTORIES[compression]
+        self._interval = interval
+        self._compressor = self._new_compressor() if self._new_compressor is not None else None
+        self._position = 0
+        self._segment_size = 0
+        self.checkpoints = [[0, 0]]
+
+    def write(self, data) -> int:
+        if self._compressor is None:
+            self._raw_file.write(data)
+            self._position += len(data)
+            return len(data)
+
+        view = memoryview(data).cast("B")
+        while len(view) > 0:
+            size = min(len(view), self._interval - self._segment_size)
+            self._raw_file.write(self._compressor.compress(view[:size]))
+            view = view[size:]
+            self._position += size
+            self._segment_size += size
+            if self._segment_size >= self._interval:
+                self._raw_file.write(self._compressor.flush())
+                self._compressor = self._new_compressor()
+                self._segment_size = 0
+                self.checkpoints.append([self._raw_file.tell(), self._position])
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self):
+        if self._compressor is not None:
+            self._raw_file.write(self._compressor.flush())
+            self._compressor = None
+
+
+class _TrackedTarFile(tarfile.TarFile):
+    """
+    The TarFile which records the (uncompressed) header offset, size and mtime of every added member,
+    and reports the member to the progress tracker if there is one.
+    """
+
+    def __init__(self, *args, tracker: Optional[_ProgressTracker] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.member_offsets = []
+        self.tracker = tracker
+
+    # tarfile supports zstd since Python 3.14 only
+    OPEN_METH = {**tarfile.TarFile.OPEN_METH, "zst": "zstopen"}
+
+    @classmethod
+    def zstopen(cls, name, mode="r", fileobj=None, **kwargs):
+        # Only for writing, a zst tar file is read in the stream mode over _open_codec_reader
+        if mode not in ("w", "x") or fileobj is None:
+            raise ValueError("The zst tar file can only be written to a file object!")
+        _check_zstd("tar")
+        stream = _open_zstd(fileobj, "w")
+        try:
+            tar_file = cls.taropen(name, mode, stream, **kwargs)
+        except Exception:
+            stream.close()
+            raise
+        tar_file._extfileobj = False
+        return tar_file
+
+    def addfile(self, tarinfo, fileobj=None):
+        offset = self.offset
+        super().addfile(tarinfo, fileobj)
+        self.member_offsets.append([tarinfo.name, offset, tarinfo.size, tarinfo.mtime])
+        _track(self.tracker, tarinfo.name, bytes_read=tarinfo.size)
+
+
+def _make_indexed_tar(src_path_list: List[Path], dst_path: Path, compression: str,
+                      tracker: Optional[_ProgressTracker] = None):
+    with open(dst_path, "wb") as raw_file:
+        writer = _CheckpointWriter(_count_bytes(raw_file, tracker), compression, DEFAULT_CHECKPOINT_INTERVAL)
+        with _TrackedTarFile.open(fileobj=writer, mode="w", tracker=tracker) as tar_file:
+            for each in src_path_list:
+                tar_file.add(each)
+        writer.close()
+    _save_tar_index(dst_path, compression, writer.checkpoints, tar_file.member_offsets)
+
+
+def _get_tar_index_path(path: Path) -> Path:
+    return path.with_name(path.name + ".idx")
+
+
+def _save_tar_index(path: Path, compression: str, checkpoints: List[List[int]], member_offsets: List[list]):
+    stat = path.stat()
+    tar_index = {
+        "version": TAR_INDEX_VERSION,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "compression": compression,
+        "checkpoints": checkpoints,
+        "members": member_offsets
+    }
+    index_path = _get_tar_index_path(path)
+    tmp_index_path = index_path.with_name(index_path.name + ".tmp")
+    with open(tmp_index_path, "w", encoding="utf-8") as index_file:
+        json.dump(tar_index, index_file, ensure_ascii=False)
+    os.replace(tmp_index_path, index_path)
+
+
+def _load_tar_index(path: Path) -> Optional[dict]:
+    # The index is ignored when the tar file has been changed after the index is written
+    try:
+        with open(_get_tar_index_path(path), "r", encoding="utf-8") as index_file:
+            tar_index = json.load(index_file)
+    except (OSError, ValueError):
+        return None
+    stat = path.stat()
+    if tar_index.get("version") != TAR_INDEX_VERSION or tar_index.get("size") != stat.st_size \
+            or tar_index.get("mtime_ns") != stat.st_mtime_ns:
+        return None
+    return tar_index
+
+
+def _build_tar_index(path: Path, compression: str) -> dict:
+    # A tar file which is not written by make_tar(index=True) only has one checkpoint (the beginning),
+    # but the member offsets still allow un_tar to stop right after the last matched member.
+    with open(path, "rb") as raw_file, _open_codec_reader(raw_file, compression) as stream:
+        with tarfile.open(fileobj=stream, mode="r|") as tar_file:
+            member_offsets = [[member.name, member.offset, member.size, member.mtime] for member in tar_file]
+    _save_tar_index(path, compression, [[0, 0]], member_offsets)
+    return _load_tar_index(path)
+
+
+def _detect_compression(head: bytes) -> str:
+    if head.startswith(b"\x1f\x8b"):
+        return "gz"
+    elif head.startswith(b"BZh"):
+        return "bz2"
+    elif head.startswith(b"\xfd7zXZ\x00"):
+        return "xz"
+    elif head.startswith(b"\x28\xb5\x2f\xfd"):
+        return "zst"
+    return ""
+
+
+def _open_codec_reader(raw_file: BinaryIO, compression: str) -> BinaryIO:
+    # Unlike the stream mode of tarfile, the codec files also read the concatenated gz members / bz2 / xz streams
+    if compression == "gz":
+        return gzip.GzipFile(fileobj=raw_file, mode="rb")
+    elif compression == "bz2":
+        return bz2.BZ2File(raw_file, "rb")
+    elif compression == "xz":
+        return lzma.LZMAFile(raw_file, "rb")
+    elif compression == "zst":
+        _check_zstd("tar")
+        return _open_zstd(raw_file, "r")
+    return raw_file
+
+
+def _un_tar_stream(fileobj: BinaryIO, dst_dir_path: Path, selector: Optional["Selector"],
+                   compression: Optional[str], tracker: Optional[_ProgressTracker] = None) -> List[str]:
+    if compression is None:
+        if not hasattr(fileobj, "peek"):
+            raise ValueError("The compression must be specified if the source stream cannot be peeked!")
+        compression = _detect_compression(fileobj.peek(6)[:6])
+
+    matched_inner_files = []
+    stream = _open_codec_reader(fileobj, compression)
+    try:
+        with tarfile.open(fileobj=stream, mode="r|") as tar_file:
+            for member in tar_file:
+                if selector is None or selector.matches(member.name, member.size, member.mtime):
+                    tar_file.extract(member, dst_dir_path)
+                    matched_inner_files.append(member.name)
+                    _track(tracker, member.name, bytes_written=member.size)
+    finally:
+        if stream is not fileobj:
+            stream.close()
+    return matched_inner_files
+
+
+def _un_tar_indexed(src_path: Path, dst_dir_path: Path, tar_index: dict, selector: Optional["Selector"],
+                    tracker: Optional[_ProgressTracker] = None) -> List[str]:
+    compression = tar_index["compression"]
+    checkpoints = tar_index["checkpoints"]
+    checkpoint_positions = [checkpoint[1] for checkpoint in checkpoints]
+    matched_members = tar_index["members"] if selector is None else selector.filter(
+        tar_index["members"], lambda member: member[0], lambda member: member[2], lambda member: member[3])
+
+    with open(src_path, "rb") as raw_file:
+        raw_file = _count_bytes(raw_file, tracker)
+        tar_file = stream = None
+        stream_base = stream_position = 0
+        for name, offset, _, _ in matched_members:
+            if compression == "":
+                checkpoint = [offset, offset]
+            else:
+                checkpoint = checkpoints[bisect.bisect_right(checkpoint_positions, offset) - 1]
+            # Keep reading the current stream unless restarting from a later checkpoint skips more data
+            if tar_file is None or checkpoint[1] > stream_position:
+                if tar_file is not None and stream is not raw_file:
+                    stream.close()
+                raw_file.seek(checkpoint[0])
+                stream = _open_codec_reader(raw_file, compression)
+                remaining = offset - checkpoint[1]
+                while remaining > 0:
+                    skipped = len(stream.read(min(remaining, DEFAULT_BUFFER_SIZE)))
+                    if skipped == 0:
+                        raise IOError(f"The index of {src_path.name} does not match the tar file!")
+                    remaining -= skipped
+                tar_file = tarfile.open(fileobj=stream, mode="r|")
+                stream_base = offset
+
+            while (member := tar_file.next()) is not None and stream_base + member.offset < offset:
+                pass
+            if member is None or member.name != name:
+                raise IOError(f"The index of {src_path.name} does not match the tar file!")
+            tar_file.extract(member, dst_dir_path)
+            stream_position = stream_base + member.offset
+            _track(tracker, member.name, bytes_written=member.size)
+    return [member[0] for member in matched_members]
+
+
+class _IncrementalPlan(object):
+    """
+    The difference between the source files and the manifest of the previous build.
+    """
+
+    def __init__(self, manifest: Optional[dict], entries: Dict[str, dict]):
+        self.manifest = manifest
+        self.entries = entries
+        self.unchanged = []
+        self.added = []
+        self.changed = []
+        self.removed = []
+
+
+def _get_manifest_path(path: Path) -> Path:
+    return path.with_name(path.name + ".manifest.json")
+
+
+def _load_manifest(path: Path) -> Optional[dict]:
+    # The manifest is ignored when the archive has been changed after the manifest is written
+    if not path.is_file():
+        return None
+    try:
+        with open(_get_manifest_path(path), "r", encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    stat = path.stat()
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("archive_size") != stat.st_size \
+            or manifest.get("archive_mtime_ns") != stat.st_mtime_ns:
+        return None
+    return manifest
+
+
+def _save_manifest(path: Path, entries: Dict[str, dict], build: dict):
+    stat = path.stat()
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "archive_size": stat.st_size,
+        "archive_mtime_ns": stat.st_mtime_ns,
+        "entries": entries,
+        "last_build": build
+    }
+    manifest_path = _get_manifest_path(path)
+    tmp_manifest_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    with open(tmp_manifest_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=False)
+    os.replace(tmp_manifest_path, manifest_path)
+
+
+def _plan_incremental(src_path_list: List[Path], dst_path: Path, recursive: bool) -> _IncrementalPlan:
+    manifest = _load_manifest(dst_path)
+    old_entries = manifest["entries"] if manifest is not None else {}
+
+    plan = _IncrementalPlan(manifest, {})
+    for source_path in _walk_paths(src_path_list, recursive):
+        key = str(source_path)
+        stat = source_path.stat()
+        old_entry = old_entries.get(key)
+        if old_entry is not None and old_entry["size"] == stat.st_size and old_entry["mtime_ns"] == stat.st_mtime_ns:
+            plan.entries[key] = old_entry
+            plan.unchanged.append(key)
+            continue
+
+        # The hash tells a touched file from a modified one, so the former can still be reused
+        digest = hash_file(key, "sha256") if source_path.is_file() else None
+        plan.entries[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": digest}
+        if old_entry is None:
+            plan.added.append(key)
+        elif old_entry["hash"] == digest:
+            plan.entries[key]["arcname"] = old_entry.get("arcname")
+            plan.unchanged.append(key)
+        else:
+            plan.changed.append(key)
+    plan.removed = [key for key in old_entries if key not in plan.entries]
+    return plan
+
+
+def _finish_incremental(plan: _IncrementalPlan, dst_path: Path, mode: str, start_time: float, reused_bytes: int):
+    """
+    Save the manifest with a report of this build. The time saved is estimated by the last full build,
+    scaled by the total size of the source files.
+    """
+    elapsed = time.perf_counter() - start_time
+    total_size = sum(entry["size"] for entry in plan.entries.values())
+    last_build = plan.manifest["last_build"] if plan.manifest is not None else {}
+    if mode == "full" or not last_build.get("full_seconds"):
+        full_seconds, full_size = elapsed, total_size
+    else:
+        full_seconds, full_size = last_build["full_seconds"], last_build["full_size"]
+    estimated_full_seconds = full_seconds * total_size / full_size if full_size else full_seconds
+    _save_manifest(dst_path, plan.entries, {
+        "mode": mode,
+        "unchanged": len(plan.unchanged),
+        "added": len(plan.added),
+        "changed": len(plan.changed),
+        "removed": len(plan.removed),
+        "reused_bytes": reused_bytes,
+        "seconds": elapsed,
+        "full_seconds": full_seconds,
+        "full_size": full_size,
+        "saved_seconds": max(0.0, estimated_full_seconds - elapsed) if mode != "full" else 0.0
+    })
+
+
+def _make_zip_incremental(src_path_list: List[Path], dst_path: Path, zip_mode: int,
+                          tracker: Optional[_ProgressTracker] = None):
+    start_time = time.perf_counter()
+    plan = _plan_incremental(src_path_list, dst_path, recursive=False)
+    for key in plan.added + plan.changed:
+        plan.entries[key]["arcname"] = zipfile.ZipInfo.from_file(key).filename
+
+    if plan.manifest is None:
+        with zipfile.ZipFile(dst_path, "w", zip_mode) as zip_file:
+            for each in src_path_list:
+                zip_file.write(each)
+                _track_zip_write(tracker, zip_file)
+        _finish_incremental(plan, dst_path, "full", start_time, 0)
+    elif not plan.added and not plan.changed and not plan.removed:
+        _finish_incremental(plan, dst_path, "skip", start_time, 0)
+    elif not plan.changed and not plan.removed:
+        with zipfile.ZipFile(dst_path, "a", zip_mode) as zip_file:
+            for key in plan.added:
+                zip_file.write(key)
+                _track_zip_write(tracker, zip_file)
+        _finish_incremental(plan, dst_path, "append", start_time, 0)
+    else:
+        # Rebuild into a temporary file, the unchanged entries are copied without being recompressed
+        reused_bytes = 0
+        reused_keys = set(plan.unchanged)
+        tmp_dst_path = dst_path.with_name(dst_path.name + ".tmp")
+        with zipfile.ZipFile(dst_path, "r") as old_zip_file, open(dst_path, "rb") as old_raw_file, \
+                zipfile.ZipFile(tmp_dst_path, "w", zip_mode) as zip_file:
+            for each in src_path_list:
+                key = str(each)
+                if key in reused_keys:
+                    old_info = old_zip_file.getinfo(plan.entries[key]["arcname"])
+                    info = copy.copy(old_info)
+                    info.date_time = zipfile.ZipInfo.from_file(each).date_time
+                    _write_zip_entry_raw(zip_file, info, _read_zip_entry_raw(old_raw_file, old_info))
+                    reused_bytes += old_info.compress_size
+                else:
+                    zip_file.write(each)
+                _track_zip_write(tracker, zip_file)
+        os.replace(tmp_dst_path, dst_path)
+        _finish_incremental(plan, dst_path, "rebuild", start_time, reused_bytes)
+
+
+def _make_tar_incremental(src_path_list: List[Path], dst_path: Path, tar_mode: str, index: bool,
+                          tracker: Optional[_ProgressTracker] = None):
+    start_time = time.perf_counter()
+    plan = _plan_incremental(src_path_list, dst_path, recursive=True)
+    compression = tar_mode.split(":")[1]
+    if plan.manifest is not None and not plan.added and not plan.changed and not plan.removed:
+        _finish_incremental(plan, dst_path, "skip", start_time, 0)
+    elif plan.manifest is not None and not plan.changed and not plan.removed and compression == "" and not index:
+        # The members of a new file under a directory are appended one by one, instead of adding the directory
+        with _TrackedTarFile.open(dst_path, "a:", tracker=tracker) as tar_file:
+            for key in plan.added:
+                tar_file.add(key, recursive=False)
+        _finish_incremental(plan, dst_path, "append", start_time, 0)
+    else:
+        if index:
+            _make_indexed_tar(src_path_list, dst_path, compression, tracker)
+        else:
+            with open(dst_path, "wb") as raw_file, _TrackedTarFile.open(
+                    fileobj=_count_bytes(raw_file, tracker), mode=tar_mode, tracker=tracker) as tar_file:
+                for each in src_path_list:
+                    tar_file.add(each)
+        _finish_incremental(plan, dst_path, "full", start_time, 0)
+
+
+def _walk_paths(src_path_list: List[Path], recursive: bool) -> Iterator[Path]:
+    # The same order as 'TarFile.add': a directory first, then its entries sorted by name
+    for each in src_path_list:
+        yield each
+        if recursive and each.is_dir() and not each.is_symlink():
+            yield from _scan_dir(each)
+
+
+def _scan_dir(dir_path: Path) -> Iterator[Path]:
+    with os.scandir(dir_path) as dir_entries:
+        dir_entries = sorted(dir_entries, key=lambda dir_entry: dir_entry.name)
+    for dir_entry in dir_entries:
+        path = dir_path / dir_entry.name
+        yield path
+        if dir_entry.is_dir(follow_symlinks=False):
+            yield from _scan_dir(path)
+
+
+def _make_zip_pipelined(paths: Iterable[Path], dst_path: Path, zip_mode: int, workers: int,
+                        tracker: Optional[_ProgressTracker] = None):
+    """
+    Walk -> read and compress (thread pool, zlib releases the GIL) -> write (the calling thread).
+    The larger files are written by the writer directly, so that the entries in flight (and the one being written)
+    hold PIPELINE_MAX_BUFFER_SIZE bytes at most, whatever the number of workers is.
+    """
+    prefetch = workers * 2
+    max_entry_size = min(PIPELINE_MAX_ENTRY_SIZE, PIPELINE_MAX_BUFFER_SIZE // (prefetch + 1))
+    with zipfile.ZipFile(dst_path, "w", zip_mode) as zip_file:
+        compress_entry = functools.partial(_compress_zip_entry, zip_mode=zip_mode, max_entry_size=max_entry_size)
+        for path, info, data in bounded_map(compress_entry, paths, workers, prefetch=prefetch):
+            if data is None:
+                zip_file.write(path)
+            else:
+                _write_zip_entry_raw(zip_file, info, [data])
+            _track_zip_write(tracker, zip_file)
+
+
+def _compress_zip_entry(path: Path, zip_mode: int,
+                        max_entry_size: int) -> Tuple[Path, zipfile.ZipInfo, Optional[bytes]]:
+    info = zipfile.ZipInfo.from_file(path)
+    if info.is_dir():
+        info.CRC = info.compress_size = 0
+        return path, info, b""
+    if info.file_size > max_entry_size:
+        return path, info, None
+
+    with open(path, "rb") as input_file:
+        # A file which grows after the stat is also left to the writer
+        data = input_file.read(max_entry_size + 1)
+    if len(data) > max_entry_size:
+        return path, info, None
+    info.file_size = len(data)
+    info.CRC = zlib.crc32(data)
+    info.compress_type = zip_mode
+    if zip_mode == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    info.compress_size = len(data)
+    return path, info, data
+
+
+def _read_zip_entry_raw(raw_file: BinaryIO, info: zipfile.ZipInfo) -> Iterator[bytes]:
+    # The data starts after the local file header, whose name and extra field may differ from the central directory
+    raw_file.seek(info.header_offset)
+    header = raw_file.read(30)
+    if header[:4] != b"PK\x03\x04":
+        raise IOError(f"Bad local file header of member {info.filename}!")
+    name_length, extra_length = struct.unpack_from("<HH", header, 26)
+    raw_file.seek(info.header_offset + 30 + name_length + extra_length)
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = raw_file.read(min(remaining, DEFAULT_BUFFER_SIZE))
+        if not chunk:
+            raise IOError(f"Unexpected end of data of member {info.filename}!")
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _write_zip_entry_raw(zip_file: zipfile.ZipFile, info: zipfile.ZipInfo, chunks: Iterable[bytes]):
+    """
+    Append an entry whose data is already compressed, the CRC and sizes of the info must be set.
+    There is no public API of zipfile for this, so it does what 'ZipFile.writestr' does with the same internals.
+    """
+    # The sizes are written into the local header, so neither the data descriptor nor the old zip64 extra is needed
+    info.flag_bits &= ~0x08
+    info.extra = _strip_zip_extra(info.extra, ZIP64_EXTRA_HEADER_ID)
+    with zip_file._lock:
+        if zip_file._seekable:
+            zip_file.fp.seek(zip_file.start_dir)
+        info.header_offset = zip_file.fp.tell()
+        zip_file._writecheck(info)
+        zip_file._didModify = True
+        zip_file.fp.write(info.FileHeader())
+        for chunk in chunks:
+            zip_file.fp.write(chunk)
+        zip_file.start_dir = zip_file.fp.tell()
+        zip_file.filelist.append(info)
+        zip_file.NameToInfo[info.filename] = info
+
+
+def _strip_zip_extra(extra: bytes, header_id: int) -> bytes:
+    # The extra field is a list of (header id, data size, data), see APPNOTE.TXT 4.5.1
+    fields = []
+    offset = 0
+    while offset + 4 <= len(extra):
+        field_id, field_size = struct.unpack("<HH", extra[offset:offset + 4])
+        end = offset + 4 + field_size
+        if field_id != header_id:
+            fields.append(extra[offset:end])
+        offset = end
+    return b"".join(fields) + extra[offset:]
+
+
+def _check_zstd(operation: str):
+    if zstd is None and zstandard is None:
+        raise RuntimeError(f"The module 'compression.zstd' or the lib 'zstandard' is needed for the {operation} "
+                           f"operation!")
+
+
+def _new_zstd_compressor(level: Optional[int], workers: int = 1):
+    # Both compressors have the 'compress' and 'flush' methods, and 'flush' ends the frame by default
+    level = ZSTD_DEFAULT_LEVEL if level is None else level
+    threads = workers if workers > 1 else 0
+    if zstd is not None:
+        return zstd.ZstdCompressor(options={zstd.CompressionParameter.compression_level: level,
+                                            zstd.CompressionParameter.nb_workers: threads})
+    return zstandard.ZstdCompressor(level=level, threads=threads).compressobj()
+
+
+def _zstd_compress(data: bytes, level: Optional[int]) -> bytes:
+    compressor = _new_zstd_compressor(level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _open_zstd(raw_file: BinaryIO, mode: str, level: Optional[int] = None, workers: int = 1) -> BinaryIO:
+    # Neither of the zstd files closes the raw file, and the reader goes on reading the concatenated frames
+    if mode == "r":
+        if zstd is not None:
+            return zstd.ZstdFile(raw_file, "r")
+        return zstandard.ZstdDecompressor().stream_reader(raw_file, read_across_frames=True, closefd=False)
+
+    level = ZSTD_DEFAULT_LEVEL if level is None else level
+    threads = workers if workers > 1 else 0
+    if zstd is not None:
+        return zstd.ZstdFile(raw_file, "w", options={zstd.CompressionParameter.compression_level: level,
+                                                      zstd.CompressionParameter.nb_workers: threads})
+    return zstandard.ZstdCompressor(level=level, threads=threads).stream_writer(raw_file, closefd=False)
+
+
 def _compress_check(src: MultiPathLike, dst: AnyPathLike) -> Tuple[List[Path], Path]:
     src_path_list = to_multi_path(src)
     dst_path = to_path(dst)
@@ -300,28 +1830,38 @@ def _compress_check(src: MultiPathLike, dst: AnyPathLike) -> Tuple[List[Path], P
 
 def _decompress_check(src: AnyPathLike, dst_dir: AnyPathLike) -> Tuple[Path, Path]:
     src_path = to_path(src)
-    dst_dir_path = to_path(dst_dir)
     if not src_path.exists():
         raise IOError(f"Source file {src_path.name} does not exist!")
     if not src_path.is_file():
         raise IOError(f"Source path {src_path.name} is a directory!")
+    return src_path, _prepare_dst_dir(dst_dir)
+
+
+def _prepare_dst_dir(dst_dir: AnyPathLike) -> Path:
+    dst_dir_path = to_path(dst_dir)
     if dst_dir_path.exists() and not dst_dir_path.is_dir():
         raise IOError(f"Destination path {dst_dir_path.name} already exists but it is not a directory!")
     dst_dir_path.mkdir(parents=True, exist_ok=True)
-    return src_path, dst_dir_path
+    return dst_dir_path
+
+
+def _is_file_object(src) -> bool:
+    return hasattr(src, "read")
 
 
 def _get_tar_mode(path: Path, mode: str, compression: Optional[str] = None) -> str:
     suffixes = "".join(path.suffixes)
     if compression is None:
-        if is_match(r"\.tar", suffixes):
+        if is_match(r".*\.tar$", suffixes):
             compression = ""
-        elif is_match(r"\.(tar\.gz|tgz)", suffixes):
+        elif is_match(r".*\.(tar\.gz|tgz)$", suffixes):
             compression = "gz"
-        elif is_match(r"\.(tar\.xz|txz)", suffixes):
+        elif is_match(r".*\.(tar\.xz|txz)$", suffixes):
             compression = "xz"
-        elif is_match(r"\.(tar\.bz2|tbz|tbz2|tb2)", suffixes):
+        elif is_match(r".*\.(tar\.bz2|tbz|tbz2|tb2)$", suffixes):
             compression = "bz2"
+        elif is_match(r".*\.(tar\.zst|tzst)$", suffixes):
+            compression = "zst"
         else:
             raise ValueError(f"{suffixes} is not a valid tar file!")
     return f"{mode}:{compression}"
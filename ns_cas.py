@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time: 2026/10/18
+# @Author: Neil Steven
+
+import contextlib
+import errno
+import itertools
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional, Tuple, Iterator, List
+
+from ns_file import FICLONE, HashCache, hash_file
+from ns_path import AnyPathLike, to_path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = [
+    "ContentStore"
+]
+
+# The stale temporary files and unreferenced objects younger than it are kept by gc, they may be still in use
+DEFAULT_GC_GRACE_SECONDS = 3600
+# The candidates re-checked and removed by gc in each short transaction, the store is only locked during them
+GC_BATCH_SIZE = 256
+
+
+class ContentStore(object):
+    """
+    The content-addressed file store, every file is stored once under its hash_file digest, e.g.
+    '<root>/objects/ab/cd/abcd...' with the default sharding, and the reference counts are kept in SQLite.
+
+    store = ContentStore("/data/cas")
+    digest = store.ingest("third_party/lib.tar.gz")
+    store.materialize(digest, "workspace/lib.tar.gz")
+    store.release(digest)
+    store.gc()
+
+    Attention:
+    1. ingest and materialize both take a reference, which is dropped by release, and gc removes the objects
+       which are not referenced any more
+    2. The objects are read-only. A hard linked copy shares the object, so it must not be modified in place
+       (replace it instead), while a reflink or byte copy is independent
+    3. It is safe to share a store between threads and processes, the reference counts and the removal of
+       objects are serialized by the transactions of SQLite
+    """
+
+    def __init__(self, root: AnyPathLike, *, algorithm: str = "sha256", shard_depth: int = 2,
+                 shard_width: int = 2):
+        self.root = to_path(root)
+        self.algorithm = algorithm
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+        self._objects_dir = self.root / "objects"
+        self._tmp_dir = self.root / "tmp"
+        self._objects_dir.mkdir(parents=True, exist_ok=True)
+        self._tmp_dir.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # The transactions are managed explicitly, so that a write lock is taken before reading the counts
+        self._connection = sqlite3.connect(self.root / "refs.sqlite3", timeout=60, isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS refs "
+                                 "(digest TEXT PRIMARY KEY, count INTEGER NOT NULL, size INTEGER NOT NULL)")
+
+    def __enter__(self) -> "ContentStore":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def path_of(self, digest: str) -> Path:
+        shards = [digest[i * self.shard_width:(i + 1) * self.shard_width] for i in range(self.shard_depth)]
+        return self._objects_dir.joinpath(*shards, digest)
+
+    def contains(self, digest: str) -> bool:
+        return self.path_of(digest).is_file()
+
+    def refcount(self, digest: str) -> int:
+        with self._lock:
+            row = self._connection.execute("SELECT count FROM refs WHERE digest = ?", (digest,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def ingest(self, path: AnyPathLike, *, cache: Optional[HashCache] = None) -> str:
+        """
+        Store the file and take a reference of it, return its digest.
+        The file is copied to a temporary file first and the digest is computed from the copy, then the copy is
+        renamed into place, so a half written object can never be seen. If the content is already in the store,
+        the copy is dropped. With a cache, the file is not even copied when its cached digest is in the store.
+        """
+        src_path = to_path(path)
+        if not src_path.is_file():
+            raise IOError(f"Could not ingest the file {src_path} because it does not exist!")
+        if cache is not None:
+            digest = hash_file(str(src_path), self.algorithm, cache=cache)
+            with self._transaction():
+                if self.contains(digest):
+                    self._add_ref(digest)
+                    return digest
+
+        tmp_path = self._tmp_dir / f"{uuid.uuid4().hex}.tmp"
+        try:
+            shutil.copyfile(src_path, tmp_path)
+            with open(tmp_path, 'rb') as tmp_file:
+                os.fsync(tmp_file.fileno())
+            os.chmod(tmp_path, 0o444)
+            digest = hash_file(str(tmp_path), self.algorithm)
+            with self._transaction():
+                object_path = self.path_of(digest)
+                if not object_path.is_file():
+                    object_path.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(tmp_path, object_path)
+                self._add_ref(digest)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return digest
+
+    def materialize(self, digest: str, dst: AnyPathLike, *, link: str = "auto") -> str:
+        """
+        Create the file of the object at dst and take a reference of it, an existing dst is replaced atomically.
+        The link is one of 'reflink', 'hardlink' and 'copy', and 'auto' tries them in this order.
+        """
+        if link not in ("auto", "reflink", "hardlink", "copy"):
+            raise ValueError(f"Link method '{link}' is unsupported!")
+        with self._transaction():
+            object_path = self.path_of(digest)
+            if not object_path.is_file():
+                raise IOError(f"The object {digest} is not in the store!")
+            self._add_ref(digest)
+
+        dst_path = to_path(dst)
+        tmp_path = dst_path.with_name(f".{dst_path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            dst_path.parent.mkdir(parents=True, exist_ok=True)
+            methods = ["reflink", "hardlink", "copy"] if link == "auto" else [link]
+            for i, method in enumerate(methods):
+                try:
+                    _MATERIALIZERS[method](object_path, tmp_path)
+                    break
+                except OSError:
+                    tmp_path.unlink(missing_ok=True)
+                    if i == len(methods) - 1:
+                        raise
+            os.replace(tmp_path, dst_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            self.release(digest)
+            raise
+        return str(dst_path.resolve())
+
+    def retain(self, digest: str):
+        with self._transaction():
+            if not self.contains(digest):
+                raise IOError(f"The object {digest} is not in the store!")
+            self._add_ref(digest)
+
+    def release(self, digest: str):
+        with self._transaction() as connection:
+            cursor = connection.execute("UPDATE refs SET count = count - 1 WHERE digest = ? AND count > 0",
+                                        (digest,))
+            if cursor.rowcount == 0:
+                raise ValueError(f"The object {digest} is not referenced!")
+
+    def gc(self, *, grace_seconds: float = DEFAULT_GC_GRACE_SECONDS) -> Tuple[int, int]:
+        """
+        Remove the objects which are not referenced any more, return (removed objects, freed bytes).
+        The objects without a count (left by a crash) and the stale temporary files are removed after grace_seconds.
+        """
+        removed = freed = 0
+        expire_time = time.time() - grace_seconds
+        # The store is scanned without the write lock, and every candidate is checked again before it is removed
+        candidates = self._scan_gc_candidates(expire_time)
+        while batch := list(itertools.islice(candidates, GC_BATCH_SIZE)):
+            batch_removed, batch_freed = self._remove_unreferenced(batch)
+            removed += batch_removed
+            freed += batch_freed
+        for tmp_path in _scan_old_files(self._tmp_dir, expire_time):
+            tmp_path.unlink(missing_ok=True)
+        return removed, freed
+
+    def _scan_gc_candidates(self, expire_time: float) -> Iterator[Path]:
+        with self._lock:
+            digests = [row[0] for row in self._connection.execute("SELECT digest FROM refs WHERE count <= 0")]
+        yield from (self.path_of(digest) for digest in digests)
+        # The objects without a count
+        for object_path in _scan_old_files(self._objects_dir, expire_time):
+            with self._lock:
+                row = self._connection.execute("SELECT 1 FROM refs WHERE digest = ?", (object_path.name,)).fetchone()
+            if row is None:
+                yield object_path
+
+    def _remove_unreferenced(self, object_paths: List[Path]) -> Tuple[int, int]:
+        removed = freed = 0
+        with self._transaction() as connection:
+            for object_path in object_paths:
+                digest = object_path.name
+                row = connection.execute("SELECT count FROM refs WHERE digest = ?", (digest,)).fetchone()
+                if row is not None and row[0] > 0:
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    size = object_path.stat().st_size
+                    object_path.unlink()
+                    removed += 1
+                    freed += size
+                connection.execute("DELETE FROM refs WHERE digest = ?", (digest,))
+        return removed, freed
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # 'BEGIN IMMEDIATE' takes the write lock, so gc cannot remove an object between the check and the count
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def _add_ref(self, digest: str):
+        size = self.path_of(digest).stat().st_size
+        self._connection.execute("INSERT INTO refs VALUES (?, 1, ?) "
+                                 "ON CONFLICT (digest) DO UPDATE SET count = count + 1", (digest, size))
+
+
+def _scan_old_files(dir_path: Path, expire_time: float) -> Iterator[Path]:
+    with os.scandir(dir_path) as dir_entries:
+        dir_entries = list(dir_entries)
+    for dir_entry in dir_entries:
+        if dir_entry.is_dir(follow_symlinks=False):
+            yield from _scan_old_files(Path(dir_entry.path), expire_time)
+        elif dir_entry.stat(follow_symlinks=False).st_mtime < expire_time:
+            yield Path(dir_entry.path)
+
+
+def _reflink(src_path: Path, dst_path: Path):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflink is not supported on this platform!")
+    with open(src_path, 'rb') as input_file, open(dst_path, 'wb') as output_file:
+        fcntl.ioctl(output_file.fileno(), FICLONE, input_file.fileno())
+
+
+def _copy(src_path: Path, dst_path: Path):
+    shutil.copyfile(src_path, dst_path)
+
+
+_MATERIALIZERS = {
+    "reflink": _reflink,
+    "hardlink": os.link,
+    "copy": _copy
+}
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time: 2026/10/18
+# @Author: Neil Steven
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+__all__ = [
+    "bounded_map"
+]
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def bounded_map(func: Callable[[T], R], iterable: Iterable[T], workers: int, *,
+                prefetch: Optional[int] = None) -> Iterator[R]:
+    """
+    Map the function over the iterable on a thread pool and yield the results in order.
+    Unlike 'Executor.map', the iterable is consumed lazily and at most 'prefetch' items are in flight,
+    so a huge input (e.g. the blocks of a large file) does not pile up in memory.
+    """
+    if workers < 1:
+        raise ValueError(f"The number of workers must be positive, got {workers}!")
+    if prefetch is None:
+        prefetch = workers * 2
+
+    pending = deque()
+    with ThreadPoolExecutor(workers) as executor:
+        try:
+            for item in iterable:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
@@ -3,20 +3,134 @@
 # @Time: 2021/6/29
 # @Author: Neil Steven
 
+import codecs
+import errno
+import functools
 import hashlib
+import itertools
 import mimetypes
+import os
+import re
 import shutil
-from typing import IO
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from stat import S_ISDIR, S_ISLNK, S_ISREG
+from typing import IO, Callable, Dict, Iterable, Iterator, NamedTuple, Tuple, Union, Optional, List
 
-from ns_path import AnyPathLike, to_path
+from ns_concurrent import bounded_map
+from ns_path import AnyPathLike, MultiPathLike, to_path, to_multi_path
 from ns_string import fuzzy_format
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 __all__ = [
-    "copy", "move", "delete",
-    "get_content_type",
-    "smart_open",
-    "hash_file"
+    "copy", "move", "delete", "bulk_copy", "bulk_move", "sync", "SyncResult",
+    "get_content_type", "get_content_types",
+    "smart_open", "detect_encoding", "transcode",
+    "hash_file", "hash_file_multi", "hash_tree", "find_duplicates", "HashCache"
+]
+
+# Copying is mostly waiting for the disk, so there are more workers than the CPUs
+DEFAULT_COPY_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+# The ioctl which clones the data of a file on the copy-on-write filesystems (btrfs, xfs, ...) of Linux
+FICLONE = 0x40049409
+# The (method, source device, destination device) which is known to be unsupported
+_unsupported_copy_methods = set()
+# The changed files are compared and rewritten by the blocks of this size, and the smaller files are copied entirely
+SYNC_BLOCK_SIZE = 128 * 1024
+SYNC_DELTA_THRESHOLD = 4 * SYNC_BLOCK_SIZE
+# Deleting is mostly waiting for the filesystem too, and every task of the workers unlinks a batch of names
+DEFAULT_DELETE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+DELETE_BATCH_SIZE = 1024
+# The single background thread which finishes the deferred deletions
+_trash_executor = None
+_trash_executor_lock = threading.Lock()
+# The chunk fed to the hash objects each time, large enough to amortize the Python overhead and small enough for
+# the CPU cache, since every chunk is hashed by all the algorithms before the next one is read
+DEFAULT_HASH_CHUNK_SIZE = 1024 * 1024
+# The bytes of the head and the tail of a file hashed by the second tier of find_duplicates
+DEDUPE_PARTIAL_SIZE = 16 * 1024
+DEFAULT_HASH_WORKERS = min(32, os.cpu_count() or 1)
+DEFAULT_HASH_CACHE_ENTRIES = 1000000
+# The bytes read from the beginning of a file to detect its encoding
+ENCODING_SAMPLE_SIZE = 64 * 1024
+# The bytes read and transcoded each time by transcode
+DEFAULT_TRANSCODE_CHUNK_SIZE = 1024 * 1024
+# The BOMs of utf-32 must be checked before utf-16, since BOM_UTF32_LE starts with BOM_UTF16_LE
+_BOM_ENCODINGS = [
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16")
 ]
+# The bytes read from the beginning of a file to sniff its content type, enough for the header of tar
+CONTENT_SNIFF_SIZE = 512
+# Sniffing only reads a few bytes of each file, so the workers are mostly waiting for the metadata of the filesystem
+DEFAULT_CONTENT_TYPE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+DEFAULT_CONTENT_TYPE_CACHE_ENTRIES = 100000
+# (signature, content type, the more specific types of the extension accepted for it), and the first matched wins
+_MAGIC_SIGNATURES = [
+    (rb"\x89PNG\r\n\x1a\n", "image/png", None),
+    (rb"\xff\xd8\xff", "image/jpeg", None),
+    (rb"GIF8[79]a", "image/gif", None),
+    (rb"RIFF.{4}WEBP", "image/webp", None),
+    (rb"II\*\x00|MM\x00\*", "image/tiff", None),
+    (rb"RIFF.{4}WAVE", "audio/x-wav", None),
+    (rb"RIFF.{4}AVI ", "video/x-msvideo", None),
+    (rb"OggS", "audio/ogg", r"(audio|video)/ogg"),
+    (rb"fLaC", "audio/flac", None),
+    (rb"ID3[\x02-\x04]|\xff[\xf2\xf3\xfb]", "audio/mpeg", None),
+    (rb".{4}ftypqt  ", "video/quicktime", None),
+    (rb".{4}ftyp", "video/mp4", r"(audio|video|image)/"),
+    (rb"\x1aE\xdf\xa3", "video/x-matroska", r"video/webm"),
+    (rb"%PDF-", "application/pdf", None),
+    (rb"%!PS", "application/postscript", None),
+    (rb"\{\\rtf", "application/rtf", None),
+    (rb"PK\x03\x04|PK\x05\x06", "application/zip",
+     r"application/(vnd\.openxmlformats-officedocument\.|vnd\.oasis\.opendocument\.|java-archive|epub\+zip|"
+     r"vnd\.android\.package-archive)"),
+    (rb"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/x-ole-storage", r"application/(msword|vnd\.ms-|x-msi)"),
+    (rb"\x1f\x8b", "application/gzip", None),
+    (rb"BZh[1-9](?:1AY&SY|\x17rE8P\x90)", "application/x-bzip2", None),
+    (rb"\xfd7zXZ\x00", "application/x-xz", None),
+    (rb"\x28\xb5\x2f\xfd", "application/zstd", None),
+    (rb"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed", None),
+    (rb"Rar!\x1a\x07", "application/vnd.rar", None),
+    (rb".{257}ustar", "application/x-tar", None),
+    (rb"SQLite format 3\x00", "application/vnd.sqlite3", None),
+    (rb"\x7fELF", "application/x-executable", r"application/x-(sharedlib|object|executable)"),
+    # It is also checked that e_lfanew of the DOS header points to the PE signature, see _match_magic
+    (rb"MZ.{58}", "application/x-msdos-program", r"application/(x-ms|vnd\.microsoft\.portable-executable)"),
+    (rb"\s*(?i:<!doctype html|<html)", "text/html", None),
+    (rb"<\?xml", "application/xml", r".*xml$")
+]
+# All the signatures are matched by one regex, and the index of the matched group is the index of the signature
+_MAGIC_PATTERN = re.compile(b"|".join(b"(" + signature + b")" for signature, _, _ in _MAGIC_SIGNATURES), re.DOTALL)
+_MAGIC_REFINEMENTS = {content_type: re.compile(refinement)
+                      for _, content_type, refinement in _MAGIC_SIGNATURES if refinement is not None}
+# The types of the extensions which win over the magic bytes if the header is utf-8 text, e.g. a csv starting with 'MZ,'
+_TEXT_TYPE_PATTERN = re.compile(r"text/|application/(json|xml|javascript|x-sh)$|.*\+(xml|json)$")
+# The (content type, is utf-8 text) sniffed from the headers (without the extensions) by _get_file_identity, the oldest
+# entries are dropped when it is full
+_content_type_cache = {}
+_content_type_cache_lock = threading.Lock()
+
+
+class SyncResult(NamedTuple):
+    files_transferred: int
+    files_skipped: int
+    bytes_transferred: int
+    bytes_skipped: int
 
 
 def copy(src: AnyPathLike, dst: AnyPathLike):
@@ -25,7 +139,10 @@ def copy(src: AnyPathLike, dst: AnyPathLike):
     if not src.exists():
         raise IOError(f"Could not copy the file {src} because it does not exist!")
     dst.mkdir(parents=True, exist_ok=True)
-    shutil.copytree(src, dst) if src.is_dir() else shutil.copy(src, dst)
+    if src.is_dir():
+        shutil.copytree(src, dst, copy_function=_copy_file, dirs_exist_ok=True)
+    else:
+        _copy_file(src, dst / src.name)
 
 
 def move(src: AnyPathLike, dst: AnyPathLike):
@@ -34,53 +151,950 @@ def move(src: AnyPathLike, dst: AnyPathLike):
     if not src.exists():
         raise IOError(f"Could not move the file {src} because it does not exist!")
     dst.mkdir(parents=True, exist_ok=True)
-    shutil.move(src, dst)
+    # It is a rename in the same filesystem, and a copy with the metadata otherwise
+    shutil.move(src, dst, copy_function=functools.partial(_copy_file, metadata=True))
+
 
+def delete(path: AnyPathLike, *, workers: int = DEFAULT_DELETE_WORKERS, deferred: bool = False) -> Optional[Future]:
+    """
+    Delete the file or directory tree, the entries of a tree are unlinked in batches on a thread pool.
+    If deferred is True, the target is renamed to a hidden name beside it and a Future is returned at once, while
+    a background thread deletes it.
 
-def delete(path: AnyPathLike):
+    Attention:
+    1. The rename is atomic, so the original path is free to be reused as soon as delete returns
+    2. The pending deferred deletions are finished before the interpreter exits, but the hidden '.*.deleting'
+       entries are left if the process is killed
+    3. The symlinks are deleted instead of being followed
+    """
     path = to_path(path)
-    if not path.exists():
+    if not path.exists() and not path.is_symlink():
         raise IOError(f"Could not delete the file {path} because it does not exist!")
-    shutil.rmtree(path) if path.is_dir() else path.unlink()
+    if deferred:
+        trash_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.deleting")
+        os.rename(path, trash_path)
+        return _get_trash_executor().submit(_delete_trash, trash_path, workers)
+    _delete_path(path, workers)
+    return None
+
+
+def bulk_copy(src: MultiPathLike, dst_dir: AnyPathLike, *, workers: int = DEFAULT_COPY_WORKERS,
+              metadata: bool = False) -> List[str]:
+    """
+    Copy the files and directories into the destination directory, and the files (including the ones under
+    the directories) are copied on a thread pool. Return the paths of the copies.
+
+    Attention:
+    1. The data is cloned (reflink) if the filesystem supports it, or copied in the kernel by copy_file_range /
+       sendfile, and it is only read into the user space when none of them works
+    2. The permission bits are always copied, and the times / flags are also copied if metadata is True
+    3. The symlinks are copied as symlinks
+    """
+    src_path_list = to_multi_path(src)
+    dst_dir = to_path(dst_dir)
+    for src_path in src_path_list:
+        if not src_path.exists() and not src_path.is_symlink():
+            raise IOError(f"Could not copy the file {src_path} because it does not exist!")
+    dst_dir.mkdir(parents=True, exist_ok=True)
+
+    copied_dirs = []
+    copy_file = functools.partial(_copy_entry, metadata=metadata)
+    for _ in bounded_map(copy_file, _walk_copy(src_path_list, dst_dir, copied_dirs), workers):
+        pass
+    # The mtime of a directory is changed by the entries created in it, so it is copied at last
+    if metadata:
+        for src_path, dst_path in reversed(copied_dirs):
+            shutil.copystat(src_path, dst_path)
+    return [os.path.abspath(dst_dir / src_path.name) for src_path in src_path_list]
+
+
+def bulk_move(src: MultiPathLike, dst_dir: AnyPathLike, *, workers: int = DEFAULT_COPY_WORKERS,
+              metadata: bool = True) -> List[str]:
+    """
+    Move the files and directories into the destination directory. Return the new paths.
+    A file or directory tree in the same filesystem is renamed, and the others are copied by bulk_copy and deleted.
+    """
+    src_path_list = to_multi_path(src)
+    dst_dir = to_path(dst_dir)
+    for src_path in src_path_list:
+        if not src_path.exists() and not src_path.is_symlink():
+            raise IOError(f"Could not move the file {src_path} because it does not exist!")
+        if (dst_dir / src_path.name).exists():
+            raise IOError(f"Could not move the file {src_path} because {dst_dir / src_path.name} already exists!")
+    dst_dir.mkdir(parents=True, exist_ok=True)
+
+    cross_device_paths = []
+    for src_path in src_path_list:
+        try:
+            os.rename(src_path, dst_dir / src_path.name)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            cross_device_paths.append(src_path)
+    if cross_device_paths:
+        bulk_copy(cross_device_paths, dst_dir, workers=workers, metadata=metadata)
+        for src_path in cross_device_paths:
+            shutil.rmtree(src_path) if src_path.is_dir() and not src_path.is_symlink() else src_path.unlink()
+    return [os.path.abspath(dst_dir / src_path.name) for src_path in src_path_list]
+
+
+def sync(src: AnyPathLike, dst: AnyPathLike, *, workers: int = DEFAULT_COPY_WORKERS, delete: bool = False,
+         block_size: int = SYNC_BLOCK_SIZE) -> SyncResult:
+    """
+    Make dst a mirror of src (a directory or a file) and only write what is changed, the files are synced on a
+    thread pool. A file is synced into dst if dst is an existing directory, the same as copy.
+
+    Attention:
+    1. The files with the same size and mtime are skipped without being read
+    2. A changed file not smaller than SYNC_DELTA_THRESHOLD is compared with its old copy block by block, and only
+       the different blocks are written in place, the other changed files are copied entirely
+    3. The times are copied at last, so a file interrupted in the middle is synced again next time
+    4. A changed file of dst which has other hard links is replaced by a new file, instead of being written in
+       place, so the other links keep the old content
+    5. The entries of dst which are not in src are deleted if delete is True, but a directory is never deleted to
+       be replaced by a file of src, IOError is raised instead
+    """
+    src_path = to_path(src)
+    dst_path = to_path(dst)
+    if not src_path.exists():
+        raise IOError(f"Could not sync the file {src_path} because it does not exist!")
+    if block_size < 1:
+        raise ValueError(f"The block size must be positive, got {block_size}!")
+
+    synced_dirs = []
+    if src_path.is_dir():
+        entries = _walk_sync(src_path, dst_path, delete, synced_dirs)
+    else:
+        if dst_path.is_dir():
+            dst_path = dst_path / src_path.name
+        dst_path.parent.mkdir(parents=True, exist_ok=True)
+        entries = iter([(src_path, dst_path)])
+    files_transferred = files_skipped = bytes_transferred = bytes_skipped = 0
+    sync_file = functools.partial(_sync_file, block_size=block_size)
+    for changed, transferred, skipped in bounded_map(sync_file, entries, workers):
+        if changed:
+            files_transferred += 1
+        else:
+            files_skipped += 1
+        bytes_transferred += transferred
+        bytes_skipped += skipped
+    for src_dir, dst_dir in reversed(synced_dirs):
+        shutil.copystat(src_dir, dst_dir)
+    return SyncResult(files_transferred, files_skipped, bytes_transferred, bytes_skipped)
 
 
-def get_content_type(path: AnyPathLike) -> str:
-    return mimetypes.guess_type(path)[0]
+def get_content_type(path: AnyPathLike, *, sniff: bool = False) -> Optional[str]:
+    """
+    Guess the content type by the extension, or by the header of the file first if sniff is True.
+    See get_content_types for the details of sniffing.
+    """
+    if not sniff:
+        return mimetypes.guess_type(path)[0]
+    return _sniff_content_type(to_path(path))
+
+
+def get_content_types(paths: Iterable[AnyPathLike], *, workers: int = DEFAULT_CONTENT_TYPE_WORKERS,
+                      on_error: Optional[Callable[[OSError], None]] = None) -> Iterator[Tuple[str, Optional[str]]]:
+    """
+    Classify the files by their headers on a thread pool, and yield (path, content type) in order.
+    The paths are consumed lazily, so it is fine to pass a generator of millions of files.
+
+    Attention:
+    1. Only the first CONTENT_SNIFF_SIZE bytes are read, and they are matched with the magic bytes of the common
+       formats. The extension is used if nothing matches, or if it is a more specific type of the matched
+       container (e.g. '.docx' of a zip)
+    2. A file matched nothing and without a known extension is 'text/plain' if its header looks like text, and
+       'application/octet-stream' otherwise, and None if it is empty
+    3. The results are cached by (device, inode, size, mtime), so a file is read again only if it is changed
+    4. The files which disappear or cannot be read are skipped, and the errors are passed to on_error if it is given
+    """
+    if on_error is None:
+        on_error = _ignore_error
+    return _get_content_types(paths, workers, on_error)
 
 
 def smart_open(file, **kwargs) -> IO:
-    from chardet import UniversalDetector
-    with open(file, 'rb') as detect_handler:
-        detector = UniversalDetector()
-        for line in detect_handler.readlines():
-            detector.feed(line)
-            if detector.done:
-                break
-        detector.close()
-    kwargs["encoding"] = detector.result["encoding"]
+    kwargs["encoding"] = detect_encoding(file)
     return open(file, **kwargs)
 
 
-def hash_file(file_path: str, algorithm: str, chuck_size: int = 8192) -> str:
-    algorithm = fuzzy_format(algorithm)
-    match algorithm:
+def detect_encoding(file) -> Optional[str]:
+    """
+    Detect the encoding of a text file from its first ENCODING_SAMPLE_SIZE bytes.
+
+    Attention:
+    1. A file with BOM, or whose sample is valid utf-8 (including pure ascii) is detected without chardet
+    2. Otherwise the python lib 'chardet' is needed, and None is returned if it cannot tell the encoding
+    3. The result is cached by (path, size, mtime), so a file is only sampled again after it is changed
+    """
+    stat = os.stat(file)
+    return _detect_encoding(os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+
+
+def transcode(src: MultiPathLike, dst: AnyPathLike, target: str = "utf-8", *, source: Optional[str] = None,
+              errors: str = "strict", workers: int = 1,
+              chunk_size: int = DEFAULT_TRANSCODE_CHUNK_SIZE) -> List[str]:
+    """
+    Convert the encoding of text files chunk by chunk, so the memory usage does not grow with the file size.
+    If src is a list, dst is the directory of the output files which keep their names (so the names must be unique),
+    otherwise dst is the file.
+
+    Attention:
+    1. The source encoding is detected by detect_encoding if it is not specified
+    2. The incremental codecs keep the incomplete multibyte characters between the chunks
+    3. If workers is more than 1, the files are converted on a process pool
+    4. The output file is written to a temporary file first, so src and dst can be the same file
+    """
+    src_path_list = to_multi_path(src)
+    for src_path in src_path_list:
+        if not src_path.is_file():
+            raise IOError(f"Could not transcode the file {src_path} because it does not exist!")
+    codecs.lookup(target)
+
+    if isinstance(src, list):
+        # The files of the same name would be written to the same output (and temporary) file
+        names = [src_path.name for src_path in src_path_list]
+        duplicate_names = sorted({name for name in names if names.count(name) > 1})
+        if duplicate_names:
+            raise ValueError(f"Could not transcode the files of the same name {duplicate_names} into one directory!")
+        dst_dir = to_path(dst)
+        dst_dir.mkdir(parents=True, exist_ok=True)
+        dst_path_list = [dst_dir / name for name in names]
+    else:
+        dst_path_list = [to_path(dst)]
+        dst_path_list[0].parent.mkdir(parents=True, exist_ok=True)
+
+    transcode_file = functools.partial(_transcode_file, target=target, source=source, errors=errors,
+                                       chunk_size=chunk_size)
+    if workers > 1 and len(src_path_list) > 1:
+        with ProcessPoolExecutor(min(workers, len(src_path_list))) as executor:
+            return list(executor.map(transcode_file, src_path_list, dst_path_list))
+    return [transcode_file(src_path, dst_path) for src_path, dst_path in zip(src_path_list, dst_path_list)]
+
+
+def hash_file(file_path: str, algorithm: str, chuck_size: int = DEFAULT_HASH_CHUNK_SIZE, *,
+              cache: Optional["HashCache"] = None) -> str:
+    return hash_file_multi(file_path, [algorithm], chuck_size, cache=cache)[algorithm]
+
+
+def hash_file_multi(file_path: str, algorithms: Iterable[str], chunk_size: int = DEFAULT_HASH_CHUNK_SIZE, *,
+                    cache: Optional["HashCache"] = None) -> Dict[str, str]:
+    """
+    Compute the hex digests of all the algorithms with a single read of the file, e.g.
+    hash_file_multi("a.iso", ["md5", "sha256"]) -> {"md5": "...", "sha256": "..."}
+
+    Attention:
+    1. The supported algorithms are md5, sha1, sha224, sha256, sha384, sha512, blake2b, blake2s and crc32
+    2. The file is read into one reusable buffer, so no bytes object is created for each chunk. It is not mapped
+       into memory, since reading a mapped file which is truncated at the same time kills the process (SIGBUS)
+    3. If cache is specified, the file is only read when some of the digests are not in the cache
+    """
+    hash_objs = {algorithm: _get_hash_method(algorithm)() for algorithm in algorithms}
+    if not hash_objs:
+        raise ValueError("The hash algorithms cannot be empty!")
+    if cache is None:
+        with open(file_path, 'rb') as f:
+            return _hash_opened_file(f, hash_objs, chunk_size)
+
+    stat = os.stat(file_path)
+    digests = {algorithm: cache.get(stat, algorithm) for algorithm in hash_objs}
+    missing_hash_objs = {algorithm: hash_obj for algorithm, hash_obj in hash_objs.items()
+                         if digests[algorithm] is None}
+    if not missing_hash_objs:
+        cache.count_saved_bytes(stat.st_size)
+        return digests
+
+    with open(file_path, 'rb') as f:
+        opened_stat = os.fstat(f.fileno())
+        digests.update(_hash_opened_file(f, missing_hash_objs, chunk_size))
+        # The digests of a file which is being modified are not cached
+        if _get_file_identity(opened_stat) == _get_file_identity(os.fstat(f.fileno())):
+            for algorithm in missing_hash_objs:
+                cache.put(opened_stat, algorithm, digests[algorithm])
+    return digests
+
+
+def hash_tree(root: AnyPathLike, algorithms: Union[str, Iterable[str]], *, workers: int = DEFAULT_HASH_WORKERS,
+              chunk_size: int = DEFAULT_HASH_CHUNK_SIZE,
+              cache: Optional["HashCache"] = None) -> Iterator[Tuple[str, Dict[str, str]]]:
+    """
+    Hash all the regular files under the directory on a thread pool (hashlib releases the GIL),
+    and yield (path, {algorithm: digest}) in the order of the walk, e.g.
+    for path, digests in hash_tree("release", ["md5", "sha256"], workers=8): ...
+
+    Attention:
+    1. Only a bounded number of files are in flight, so the memory usage does not grow with the tree
+    2. The entries of each directory are walked in name order, and the symlinks are not followed
+    """
+    root = to_path(root)
+    if not root.exists():
+        raise IOError(f"Could not hash the files under {root} because it does not exist!")
+    algorithms = [algorithms] if isinstance(algorithms, str) else list(algorithms)
+
+    def hash_one(path: str) -> Tuple[str, Dict[str, str]]:
+        return path, hash_file_multi(path, algorithms, chunk_size, cache=cache)
+
+    paths = [str(root)] if root.is_file() else _scan_files(str(root))
+    return bounded_map(hash_one, paths, workers)
+
+
+def find_duplicates(src: MultiPathLike, *, algorithm: str = "sha256", min_size: int = 1,
+                    workers: int = DEFAULT_HASH_WORKERS, hardlink: bool = False, cache: Optional["HashCache"] = None,
+                    on_error: Optional[Callable[[OSError], None]] = None) -> Iterator[List[str]]:
+    """
+    Find the files with the same content under the directories, and yield the paths of each group of duplicates,
+    the largest files first. The candidates are narrowed down in tiers, so that most files are barely read:
+    1. The files are grouped by size, which only needs the walk
+    2. The files of the same size are grouped by the hash of their first and last DEDUPE_PARTIAL_SIZE bytes
+    3. The files which are still together are hashed in whole by hash_file
+
+    Attention:
+    1. The symlinks are not followed, and the paths of a file which is already hard linked are reported only once
+    2. If hardlink is True, the duplicates are replaced by the hard links to the first file of the group
+       (on the same device), and the group is yielded after they are replaced
+    3. The files (and directories) which disappear or cannot be read during the run are skipped, and the errors
+       are passed to on_error (like os.walk) if it is given
+    """
+    src_path_list = to_multi_path(src)
+    for src_path in src_path_list:
+        if not src_path.exists():
+            raise IOError(f"Could not find the duplicates under {src_path} because it does not exist!")
+
+    if on_error is None:
+        on_error = _ignore_error
+    stats = {}
+    size_groups = {}
+    seen_files = set()
+    for src_path in src_path_list:
+        paths = [str(src_path)] if src_path.is_file() else _scan_files(str(src_path), on_error)
+        for path in paths:
+            try:
+                stat = os.stat(path, follow_symlinks=False)
+            except OSError as e:
+                on_error(e)
+                continue
+            if stat.st_size < min_size or (stat.st_dev, stat.st_ino) in seen_files:
+                continue
+            seen_files.add((stat.st_dev, stat.st_ino))
+            stats[path] = stat
+            size_groups.setdefault(stat.st_size, []).append(path)
+    size_groups = [size_groups[size] for size in sorted(size_groups, reverse=True) if len(size_groups[size]) > 1]
+    return _find_duplicates(stats, size_groups, algorithm, workers, hardlink, cache, on_error)
+
+
+class HashCache(object):
+    """
+    The persistent digest cache in SQLite, which is keyed on (device, inode, size, mtime_ns, algorithm) of a file,
+    so a hit only costs a stat. The least recently used entries are evicted when there are more than max_entries.
+    It is thread safe and can be shared by hash_tree, e.g.
+
+    with HashCache() as cache:
+        for path, digests in hash_tree("release", ["md5", "sha256"], cache=cache): ...
+        print(cache.hits, cache.misses, cache.saved_bytes)
+
+    Attention: the default path is '$XDG_CACHE_HOME/nspy/hash_cache.sqlite3' ('~/.cache' if the env is not set)
+    """
+
+    _COMMIT_INTERVAL = 1000
+
+    def __init__(self, path: Optional[AnyPathLike] = None, *, max_entries: int = DEFAULT_HASH_CACHE_ENTRIES):
+        if max_entries < 1:
+            raise ValueError(f"The max entries of the hash cache must be positive, got {max_entries}!")
+        if path is None:
+            path = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "nspy" / "hash_cache.sqlite3"
+        self.path = to_path(path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.saved_bytes = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS digests (dev INTEGER, inode INTEGER, size INTEGER, "
+                                 "mtime_ns INTEGER, algorithm TEXT, digest TEXT NOT NULL, last_used INTEGER NOT NULL, "
+                                 "PRIMARY KEY (dev, inode, size, mtime_ns, algorithm))")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used)")
+        self._connection.commit()
+        self._entries = self._connection.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+        # The last used time of the hits is written in batch, so a hit does not write the database
+        self._touched_keys = []
+        self._pending_writes = 0
+
+    def __enter__(self) -> "HashCache":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, stat: os.stat_result, algorithm: str) -> Optional[str]:
+        key = _get_file_identity(stat) + (fuzzy_format(algorithm),)
+        with self._lock:
+            row = self._connection.execute("SELECT digest FROM digests WHERE dev = ? AND inode = ? AND size = ? "
+                                           "AND mtime_ns = ? AND algorithm = ?", key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched_keys.append(key)
+            if len(self._touched_keys) >= self._COMMIT_INTERVAL:
+                self._commit()
+            return row[0]
+
+    def put(self, stat: os.stat_result, algorithm: str, digest: str):
+        key = _get_file_identity(stat) + (fuzzy_format(algorithm),)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     key + (digest, time.time_ns()))
+            self._entries += 1
+            self._pending_writes += 1
+            if self._entries > self.max_entries:
+                self._evict()
+            if self._pending_writes >= self._COMMIT_INTERVAL:
+                self._commit()
+
+    def count_saved_bytes(self, size: int):
+        with self._lock:
+            self.saved_bytes += size
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._connection.close()
+
+    def _evict(self):
+        # Evict down to 90% of the max entries, so the eviction does not run on every put
+        self._entries = self._connection.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+        if self._entries > self.max_entries:
+            self._flush_touched_keys()
+            evicted = self._entries - self.max_entries * 9 // 10
+            self._connection.execute("DELETE FROM digests WHERE rowid IN "
+                                     "(SELECT rowid FROM digests ORDER BY last_used LIMIT ?)", (evicted,))
+            self._entries -= evicted
+
+    def _flush_touched_keys(self):
+        now = time.time_ns()
+        self._connection.executemany("UPDATE digests SET last_used = ? WHERE dev = ? AND inode = ? AND size = ? "
+                                     "AND mtime_ns = ? AND algorithm = ?",
+                                     [(now,) + key for key in self._touched_keys])
+        self._touched_keys.clear()
+
+    def _commit(self):
+        self._flush_touched_keys()
+        self._connection.commit()
+        self._pending_writes = 0
+
+
+def _walk_copy(src_path_list: List[Path], dst_dir: Path, copied_dirs: list) -> Iterator[Tuple[Path, Path]]:
+    # The directories are created by the walk before any entry in them is yielded to the workers
+    for src_path in src_path_list:
+        dst_path = dst_dir / src_path.name
+        if src_path.is_dir() and not src_path.is_symlink():
+            dst_path.mkdir(exist_ok=True)
+            shutil.copymode(src_path, dst_path)
+            copied_dirs.append((src_path, dst_path))
+            with os.scandir(src_path) as dir_entries:
+                entry_paths = [Path(dir_entry.path) for dir_entry in dir_entries]
+            yield from _walk_copy(entry_paths, dst_path, copied_dirs)
+        else:
+            yield src_path, dst_path
+
+
+def _delete_path(path: Path, workers: int):
+    if not path.is_dir() or path.is_symlink():
+        path.unlink()
+        return
+    deleted_dirs = []
+    batches = _walk_delete(str(path), deleted_dirs)
+    if workers > 1:
+        batches = bounded_map(_unlink_batch, batches, workers)
+    else:
+        batches = map(_unlink_batch, batches)
+    for _ in batches:
+        pass
+    # The directories are walked from the top, so they are removed in the reverse order
+    for dir_path in reversed(deleted_dirs):
+        os.rmdir(dir_path)
+
+
+def _delete_trash(path: Path, workers: int):
+    try:
+        _delete_path(path, workers)
+    except RuntimeError:
+        # No thread pool can be started once the interpreter begins to exit, so the rest is deleted in this thread
+        _delete_path(path, 1)
+
+
+def _walk_delete(dir_path: str, deleted_dirs: list) -> Iterator[Tuple[str, List[str]]]:
+    deleted_dirs.append(dir_path)
+    names = []
+    sub_dirs = []
+    # The directory is listed entirely before any entry is unlinked, since readdir is unspecified (and may skip
+    # entries on some filesystems, e.g. NFS) if the directory is changed while it is read
+    with os.scandir(dir_path) as dir_entries:
+        for dir_entry in dir_entries:
+            if dir_entry.is_dir(follow_symlinks=False):
+                sub_dirs.append(dir_entry.path)
+            else:
+                names.append(dir_entry.name)
+    for i in range(0, len(names), DELETE_BATCH_SIZE):
+        yield dir_path, names[i:i + DELETE_BATCH_SIZE]
+    for sub_dir in sub_dirs:
+        yield from _walk_delete(sub_dir, deleted_dirs)
+
+
+def _unlink_batch(batch: Tuple[str, List[str]]):
+    dir_path, names = batch
+    if os.unlink not in os.supports_dir_fd:
+        for name in names:
+            os.unlink(os.path.join(dir_path, name))
+        return
+    # The names are resolved relative to the opened directory, instead of walking the whole path every time
+    dir_fd = os.open(dir_path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    try:
+        for name in names:
+            os.unlink(name, dir_fd=dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def _get_trash_executor() -> ThreadPoolExecutor:
+    global _trash_executor
+    with _trash_executor_lock:
+        if _trash_executor is None:
+            _trash_executor = ThreadPoolExecutor(1, thread_name_prefix="ns_file_trash")
+        return _trash_executor
+
+
+def _walk_sync(src_dir: Path, dst_dir: Path, delete: bool, synced_dirs: list) -> Iterator[Tuple[Path, Path]]:
+    if dst_dir.is_symlink() or dst_dir.exists() and not dst_dir.is_dir():
+        dst_dir.unlink()
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    synced_dirs.append((src_dir, dst_dir))
+    with os.scandir(src_dir) as dir_entries:
+        dir_entries = sorted(dir_entries, key=lambda dir_entry: dir_entry.name)
+    if delete:
+        src_names = {dir_entry.name for dir_entry in dir_entries}
+        # The directory is listed entirely before any entry is deleted, the same as _walk_delete
+        with os.scandir(dst_dir) as dst_entries:
+            extra_entries = [dst_entry for dst_entry in dst_entries if dst_entry.name not in src_names]
+        for dst_entry in extra_entries:
+            is_dir = dst_entry.is_dir(follow_symlinks=False)
+            shutil.rmtree(dst_entry.path) if is_dir else os.unlink(dst_entry.path)
+    for dir_entry in dir_entries:
+        if dir_entry.is_dir(follow_symlinks=False):
+            yield from _walk_sync(Path(dir_entry.path), dst_dir / dir_entry.name, delete, synced_dirs)
+        else:
+            yield Path(dir_entry.path), dst_dir / dir_entry.name
+
+
+def _sync_file(paths: Tuple[Path, Path], block_size: int) -> Tuple[bool, int, int]:
+    # Return whether the file is changed, and the bytes transferred and skipped
+    src_path, dst_path = paths
+    src_stat = src_path.lstat()
+    try:
+        dst_stat = dst_path.lstat()
+    except FileNotFoundError:
+        dst_stat = None
+    if dst_stat is not None and S_ISDIR(dst_stat.st_mode):
+        raise IOError(f"Could not sync the file {src_path} because {dst_path} is a directory!")
+
+    if S_ISLNK(src_stat.st_mode):
+        link = os.readlink(src_path)
+        if dst_stat is not None and S_ISLNK(dst_stat.st_mode) and os.readlink(dst_path) == link:
+            return False, 0, 0
+        dst_path.unlink(missing_ok=True)
+        os.symlink(link, dst_path)
+        return True, len(link), 0
+    if dst_stat is not None and not S_ISREG(dst_stat.st_mode):
+        dst_path.unlink()
+        dst_stat = None
+
+    if dst_stat is not None and dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime_ns == src_stat.st_mtime_ns:
+        return False, 0, src_stat.st_size
+    if dst_stat is not None and dst_stat.st_nlink > 1:
+        # Writing in place would also change the other hard links (e.g. made by find_duplicates or ContentStore),
+        # so a new file is renamed over dst instead
+        tmp_path = dst_path.with_name(f".{dst_path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            _copy_file(src_path, tmp_path, metadata=True)
+            os.replace(tmp_path, dst_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return True, src_stat.st_size, 0
+    if dst_stat is None or src_stat.st_size < SYNC_DELTA_THRESHOLD or dst_stat.st_size < SYNC_DELTA_THRESHOLD:
+        _copy_file(src_path, dst_path, metadata=True)
+        return True, src_stat.st_size, 0
+
+    transferred = 0
+    src_buffer = bytearray(block_size)
+    dst_buffer = bytearray(block_size)
+    with open(src_path, 'rb') as src_file, open(dst_path, 'r+b') as dst_file:
+        dst_file.truncate(src_stat.st_size)
+        offset = 0
+        while True:
+            size = src_file.readinto(src_buffer)
+            if size == 0:
+                break
+            src_block = memoryview(src_buffer)[:size]
+            dst_size = dst_file.readinto(dst_buffer)
+            # The blocks of both sides are local, so they are compared directly instead of by checksums
+            if dst_size != size or memoryview(dst_buffer)[:size] != src_block:
+                os.pwrite(dst_file.fileno(), src_block, offset)
+                transferred += size
+            offset += size
+    shutil.copystat(src_path, dst_path)
+    return True, transferred, src_stat.st_size - transferred
+
+
+def _copy_entry(paths: Tuple[Path, Path], metadata: bool):
+    src_path, dst_path = paths
+    if src_path.is_symlink():
+        link = os.readlink(src_path)
+        if dst_path.is_symlink() and os.path.samestat(src_path.lstat(), dst_path.lstat()):
+            raise shutil.SameFileError(f"{src_path} and {dst_path} are the same file")
+        dst_path.unlink(missing_ok=True)
+        os.symlink(link, dst_path)
+    else:
+        _copy_file(src_path, dst_path, metadata=metadata)
+
+
+def _copy_file(src: AnyPathLike, dst: AnyPathLike, metadata: bool = False) -> AnyPathLike:
+    # The same as shutil.copy / shutil.copy2 (and also used as their replacement by shutil), but the data is copied
+    # by _copy_file_data. Opening dst truncates it, so it must not be src itself
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.SameFileError(f"{src} and {dst} are the same file")
+    with open(src, 'rb') as input_file, open(dst, 'wb') as output_file:
+        _copy_file_data(input_file, output_file)
+    shutil.copystat(src, dst) if metadata else shutil.copymode(src, dst)
+    return dst
+
+
+def _copy_file_data(input_file, output_file):
+    input_fd = input_file.fileno()
+    output_fd = output_file.fileno()
+    input_stat = os.fstat(input_fd)
+    devices = (input_stat.st_dev, os.fstat(output_fd).st_dev)
+    if input_stat.st_size == 0:
+        return
+
+    if fcntl is not None and ("reflink",) + devices not in _unsupported_copy_methods:
+        try:
+            fcntl.ioctl(output_fd, FICLONE, input_fd)
+            return
+        except OSError:
+            _unsupported_copy_methods.add(("reflink",) + devices)
+
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method) or (method,) + devices in _unsupported_copy_methods:
+            continue
+        offset = 0
+        try:
+            while True:
+                if method == "copy_file_range":
+                    copied = os.copy_file_range(input_fd, output_fd, COPY_CHUNK_SIZE, offset, offset)
+                else:
+                    copied = os.sendfile(output_fd, input_fd, offset, COPY_CHUNK_SIZE)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            # Only fall back when nothing is copied yet, otherwise it is a real IO error
+            if offset > 0:
+                raise
+            _unsupported_copy_methods.add((method,) + devices)
+            continue
+        if offset > 0:
+            return
+        # Some filesystems (e.g. procfs) report nothing to copy, fall back to read them
+
+    shutil.copyfileobj(input_file, output_file)
+
+
+def _hash_opened_file(f, hash_objs: Dict[str, object], chunk_size: int) -> Dict[str, str]:
+    file_size = os.fstat(f.fileno()).st_size
+    buffer = bytearray(min(chunk_size, max(file_size, 1)))
+    with memoryview(buffer) as view:
+        while size := f.readinto(buffer):
+            for hash_obj in hash_objs.values():
+                hash_obj.update(view[:size])
+    return {algorithm: hash_obj.hexdigest() for algorithm, hash_obj in hash_objs.items()}
+
+
+def _get_content_types(paths: Iterable[AnyPathLike], workers: int,
+                       on_error: Callable[[OSError], None]) -> Iterator[Tuple[str, Optional[str]]]:
+    def classify(path: AnyPathLike) -> Tuple[str, Union[str, OSError, None]]:
+        try:
+            return str(path), _sniff_content_type(to_path(path))
+        except OSError as e:
+            return str(path), e
+
+    # The errors are passed back and reported in the calling thread, so on_error is never called concurrently
+    for path, content_type in bounded_map(classify, paths, workers):
+        if isinstance(content_type, OSError):
+            on_error(content_type)
+        else:
+            yield path, content_type
+
+
+def _sniff_content_type(path: Path) -> Optional[str]:
+    try:
+        identity = _get_file_identity(path.stat())
+    except FileNotFoundError:
+        raise IOError(f"Could not get the content type of the file {path} because it does not exist!")
+    with _content_type_cache_lock:
+        sniffed = _content_type_cache.get(identity)
+    if sniffed is None:
+        with open(path, 'rb') as f:
+            sniffed = _match_magic(f.read(CONTENT_SNIFF_SIZE))
+        with _content_type_cache_lock:
+            if len(_content_type_cache) >= DEFAULT_CONTENT_TYPE_CACHE_ENTRIES:
+                _content_type_cache.pop(next(iter(_content_type_cache)), None)
+            _content_type_cache[identity] = sniffed
+
+    sniffed_type, is_text = sniffed
+    guessed_type = _guess_content_type("".join(path.suffixes))
+    if sniffed_type in (None, "text/plain", "application/octet-stream"):
+        return guessed_type or sniffed_type
+    if is_text and guessed_type is not None and _TEXT_TYPE_PATTERN.match(guessed_type):
+        return guessed_type
+    refinement = _MAGIC_REFINEMENTS.get(sniffed_type)
+    if guessed_type is not None and refinement is not None and refinement.match(guessed_type):
+        return guessed_type
+    return sniffed_type
+
+
+@functools.lru_cache(maxsize=1024)
+def _guess_content_type(suffixes: str) -> Optional[str]:
+    return mimetypes.guess_type("file" + suffixes)[0]
+
+
+def _match_magic(header: bytes) -> Tuple[Optional[str], bool]:
+    # Return the content type of the header, and whether it is utf-8 text
+    try:
+        # The header may end in the middle of a multibyte character unless it is the whole file
+        codecs.getincrementaldecoder("utf-8")().decode(header, final=len(header) < CONTENT_SNIFF_SIZE)
+        is_text = b"\x00" not in header
+    except UnicodeDecodeError:
+        is_text = False
+
+    match = _MAGIC_PATTERN.match(header)
+    if match is not None:
+        content_type = _MAGIC_SIGNATURES[match.lastindex - 1][1]
+        if content_type != "application/x-msdos-program" or _is_pe_header(header):
+            return content_type, is_text
+    if not header:
+        return None, False
+    if any(header.startswith(bom) for bom, _ in _BOM_ENCODINGS) or b"\x00" not in header:
+        return "text/plain", is_text
+    return "application/octet-stream", is_text
+
+
+def _is_pe_header(header: bytes) -> bool:
+    pe_offset = int.from_bytes(header[0x3c:0x40], "little")
+    return header[pe_offset:pe_offset + 4] == b"PE\x00\x00"
+
+
+@functools.lru_cache(maxsize=1024)
+def _detect_encoding(path: str, size: int, mtime_ns: int) -> Optional[str]:
+    # The size and mtime_ns are only the part of the cache key
+    with open(path, 'rb') as f:
+        sample = f.read(ENCODING_SAMPLE_SIZE)
+    for bom, encoding in _BOM_ENCODINGS:
+        if sample.startswith(bom):
+            return encoding
+    try:
+        # The sample may end in the middle of a multibyte character unless it is the whole file
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=len(sample) < ENCODING_SAMPLE_SIZE)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+
+    from chardet import UniversalDetector
+    detector = UniversalDetector()
+    detector.feed(sample)
+    detector.close()
+    return detector.result["encoding"]
+
+
+def _transcode_file(src_path: Path, dst_path: Path, target: str, source: Optional[str], errors: str,
+                    chunk_size: int) -> str:
+    source = source or detect_encoding(src_path)
+    if source is None:
+        raise ValueError(f"Could not detect the encoding of the file {src_path}!")
+    decoder = codecs.getincrementaldecoder(source)(errors)
+    encoder = codecs.getincrementalencoder(target)(errors)
+
+    tmp_dst_path = dst_path.with_name(dst_path.name + ".tmp")
+    try:
+        with open(src_path, 'rb') as input_file, open(tmp_dst_path, 'wb') as output_file:
+            while chunk := input_file.read(chunk_size):
+                output_file.write(encoder.encode(decoder.decode(chunk)))
+            output_file.write(encoder.encode(decoder.decode(b"", final=True), final=True))
+    except BaseException:
+        tmp_dst_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_dst_path, dst_path)
+    return str(dst_path.resolve())
+
+
+def _get_file_identity(stat: os.stat_result) -> Tuple[int, int, int, int]:
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _scan_files(dir_path: str, on_error: Optional[Callable[[OSError], None]] = None) -> Iterator[str]:
+    # The errors are raised if on_error is None
+    try:
+        with os.scandir(dir_path) as dir_entries:
+            dir_entries = sorted(dir_entries, key=lambda dir_entry: dir_entry.name)
+    except OSError as e:
+        if on_error is None:
+            raise
+        on_error(e)
+        return
+    for dir_entry in dir_entries:
+        if dir_entry.is_dir(follow_symlinks=False):
+            yield from _scan_files(dir_entry.path, on_error)
+        elif dir_entry.is_file(follow_symlinks=False):
+            yield dir_entry.path
+
+
+def _find_duplicates(stats: Dict[str, os.stat_result], size_groups: List[List[str]], algorithm: str,
+                     workers: int, hardlink: bool, cache: Optional["HashCache"],
+                     on_error: Callable[[OSError], None]) -> Iterator[List[str]]:
+    # Tier 2 and tier 3 are chained thread pools, the results are in order, so a group ends when the key changes.
+    # A file failed to be read gets the error instead of the digest, which is reported by the calling thread
+    def hash_partial(item: Tuple[int, str]) -> Tuple[int, str, Union[str, OSError], bool]:
+        group_index, path = item
+        try:
+            digest, is_full = _hash_head_tail(path, stats[path].st_size, algorithm)
+        except OSError as e:
+            return group_index, path, e, False
+        return group_index, path, digest, is_full
+
+    def hash_full(item: Tuple[tuple, str, Optional[str]]) -> Tuple[tuple, str, Union[str, OSError]]:
+        key, path, digest = item
+        try:
+            return key, path, digest if digest is not None else hash_file(path, algorithm, cache=cache)
+        except OSError as e:
+            return key, path, e
+
+    def full_hash_candidates() -> Iterator[Tuple[tuple, str, Optional[str]]]:
+        partial_items = ((group_index, path) for group_index, group in enumerate(size_groups) for path in group)
+        partial_results = bounded_map(hash_partial, partial_items, workers)
+        for group_index, results in itertools.groupby(partial_results, key=lambda result: result[0]):
+            partial_groups = {}
+            for _, path, digest, is_full in results:
+                if isinstance(digest, OSError):
+                    on_error(digest)
+                    continue
+                partial_groups.setdefault((digest, is_full), []).append(path)
+            for (digest, is_full), paths in partial_groups.items():
+                if len(paths) > 1:
+                    # The digest of a file which is read in whole by tier 2 is already the full one
+                    yield from (((group_index, digest), path, digest if is_full else None) for path in paths)
+
+    full_results = bounded_map(hash_full, full_hash_candidates(), workers)
+    for _, results in itertools.groupby(full_results, key=lambda result: result[0]):
+        full_groups = {}
+        for _, path, digest in results:
+            if isinstance(digest, OSError):
+                on_error(digest)
+                continue
+            full_groups.setdefault(digest, []).append(path)
+        for paths in full_groups.values():
+            if len(paths) > 1:
+                if hardlink:
+                    _replace_with_hardlinks(paths, stats, on_error)
+                yield paths
+
+
+def _ignore_error(_: OSError):
+    pass
+
+
+def _hash_head_tail(path: str, size: int, algorithm: str) -> Tuple[str, bool]:
+    # A file not larger than the head and tail is read in whole, and hashed with the final algorithm
+    with open(path, 'rb') as f:
+        if size <= DEDUPE_PARTIAL_SIZE * 2:
+            hash_obj = _get_hash_method(algorithm)()
+            hash_obj.update(f.read())
+            return hash_obj.hexdigest(), True
+        head = f.read(DEDUPE_PARTIAL_SIZE)
+        f.seek(-DEDUPE_PARTIAL_SIZE, os.SEEK_END)
+        return hashlib.blake2b(head + f.read(DEDUPE_PARTIAL_SIZE)).hexdigest(), False
+
+
+def _replace_with_hardlinks(paths: List[str], stats: Dict[str, os.stat_result], on_error: Callable[[OSError], None]):
+    # The first file on each device is kept, and a file is only replaced if both of it and the kept file are not
+    # changed after the scan. If the kept file is changed, nothing on its device is replaced (marked by None)
+    kept_paths = {}
+    for path in paths:
+        device = stats[path].st_dev
+        try:
+            if device not in kept_paths:
+                kept_paths[device] = path if not _is_changed(path, stats) else None
+                continue
+            kept_path = kept_paths[device]
+            if kept_path is None or _is_changed(path, stats):
+                continue
+            if _is_changed(kept_path, stats):
+                kept_paths[device] = None
+                continue
+            tmp_path = f"{path}.{os.getpid()}.link.tmp"
+            os.link(kept_path, tmp_path)
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            on_error(e)
+
+
+def _is_changed(path: str, stats: Dict[str, os.stat_result]) -> bool:
+    return _get_file_identity(os.stat(path, follow_symlinks=False)) != _get_file_identity(stats[path])
+
+
+class _Crc32(object):
+    """
+    The crc32 of zlib with the interface of hashlib.
+    """
+
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data):
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self) -> str:
+        return f"{self._value:08x}"
+
+
+def _get_hash_method(algorithm: str):
+    match fuzzy_format(algorithm):
         case "md5":
-            hash_method = hashlib.md5
+            return hashlib.md5
         case "sha1":
-            hash_method = hashlib.sha1
+            return hashlib.sha1
         case "sha224":
-            hash_method = hashlib.sha224
+            return hashlib.sha224
         case "sha256":
-            hash_method = hashlib.sha256
+            return hashlib.sha256
         case "sha384":
-            hash_method = hashlib.sha384
+            return hashlib.sha384
         case "sha512":
-            hash_method = hashlib.sha512
+            return hashlib.sha512
+        case "blake2b" | "blake2":
+            return hashlib.blake2b
+        case "blake2s":
+            return hashlib.blake2s
+        case "crc32":
+            return _Crc32
         case _:
             raise ValueError(f"Hash algorithm '{algorithm}' is unsupported!")
-
-    with open(file_path, 'rb') as f:
-        hash_obj = hash_method()
-        while chunk := f.read(chuck_size):
-            hash_obj.update(chunk)
-    return hash_obj.hexdigest()
@@ -0,0 +1,233 @@
+"""
+    The throughput and memory benchmark of ns_archive.
+
+    It generates the synthetic corpora locally, runs every compress/decompress path in a child process,
+    and writes MB/s, peak RSS and output ratio as JSON, e.g.
+
+        PYTHONPATH=. python test/bench_ns_archive.py --scale 0.1 --output bench_output.json
+        PYTHONPATH=. python test/bench_ns_archive.py --sizes 1M,100M,10G --output sweep.json
+        PYTHONPATH=. python test/bench_ns_archive.py --baseline old.json --output new.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from ns_archive import *
+from ns_archive import py7zr, zstd, zstandard
+from ns_unit import parse_humanized_file_size
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PARALLEL_WORKERS = max(2, os.cpu_count() or 1)
+# (name, compress kwargs) of every path, the single file codecs only run on the corpora of one file
+ARCHIVE_CASES = [
+    ("zip", {}),
+    ("zip", {"workers": PARALLEL_WORKERS}),
+    ("tar", {}),
+    ("tar.gz", {}),
+    ("tar.bz2", {}),
+    ("tar.xz", {}),
+    ("tar.zst", {}),
+    ("7z", {}),
+]
+SINGLE_FILE_CASES = [
+    ("gz", {}),
+    ("gz", {"workers": PARALLEL_WORKERS}),
+    ("bz2", {}),
+    ("xz", {}),
+    ("xz", {"workers": PARALLEL_WORKERS}),
+    ("zst", {}),
+    ("zst", {"workers": PARALLEL_WORKERS}),
+]
+
+# The huge files are generated and written in chunks of this size, so the memory does not grow with --sizes
+GENERATE_CHUNK_SIZE = 1024 * 1024
+WORDS = [b"alpha", b"beta", b"gamma", b"delta", b"archive", b"stream", b"block", b"member", b"index", b"\n"]
+
+
+def parse_size(text: str) -> int:
+    # "1M" and "10G" are short for "1MiB" and "10GiB"
+    text = text.strip()
+    return parse_humanized_file_size(text + "iB" if text[-1:].upper() in "KMGT" else text)
+
+
+def make_tiny_corpora(root: Path, scale: float) -> dict:
+    rng = random.Random(0)
+    count = max(2, int(2000 * scale))
+    return {name: make_corpus(root / name, count, 1024, generate) for name, generate in [
+        ("tiny_text", lambda size: compressible(rng, size)),
+        ("tiny_random", rng.randbytes),
+    ]}
+
+
+def make_huge_corpora(root: Path, size_label: str) -> dict:
+    rng = random.Random(0)
+    size = parse_size(size_label)
+    return {name: make_corpus(root / name, 1, size, generate) for name, generate in [
+        (f"huge_text_{size_label}", lambda chunk_size: compressible(rng, chunk_size)),
+        (f"huge_random_{size_label}", rng.randbytes),
+    ]}
+
+
+def make_corpus(corpus_dir: Path, count: int, size: int, generate) -> Path:
+    corpus_dir.mkdir(parents=True)
+    for i in range(count):
+        with open(corpus_dir / f"{i:06d}.bin", "wb") as output_file:
+            for offset in range(0, size, GENERATE_CHUNK_SIZE):
+                output_file.write(generate(min(GENERATE_CHUNK_SIZE, size - offset)))
+    return corpus_dir
+
+
+def compressible(rng: random.Random, size: int) -> bytes:
+    return b" ".join(rng.choices(WORDS, k=size // 5 + 1))[:size]
+
+
+def run_case(queue, operation, src, dst, kwargs):
+    # Run in a child process, so that the peak RSS belongs to this case only
+    start_time = time.perf_counter()
+    if operation == "compress":
+        compress(src, dst, **kwargs)
+    else:
+        decompress(src, dst, **kwargs)
+    elapsed = time.perf_counter() - start_time
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource is not None else None
+    queue.put((elapsed, peak_rss))
+
+
+def measure(operation, src, dst, kwargs) -> tuple:
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_case, args=(queue, operation, src, dst, kwargs))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"The benchmark case {operation} {src} -> {dst} failed!")
+    return queue.get()
+
+
+def get_size(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(each.stat().st_size for each in path.rglob("*") if each.is_file())
+
+
+def run(scale: float, sizes: list, work_dir: Path) -> list:
+    results = []
+    for corpus_name, corpus_dir in make_tiny_corpora(work_dir / "corpora", scale).items():
+        results += run_corpus(corpus_name, corpus_dir, work_dir)
+    # Only one size of the huge corpora is on the disk at a time
+    for size_label in sizes:
+        for corpus_name, corpus_dir in make_huge_corpora(work_dir / "corpora", size_label).items():
+            results += run_corpus(corpus_name, corpus_dir, work_dir)
+            shutil.rmtree(corpus_dir)
+    return results
+
+
+def run_corpus(corpus_name: str, corpus_dir: Path, work_dir: Path) -> list:
+    results = []
+    files = sorted(corpus_dir.iterdir())
+    cases = ARCHIVE_CASES + (SINGLE_FILE_CASES if len(files) == 1 else [])
+    input_size = get_size(corpus_dir)
+    for index, (suffix, kwargs) in enumerate(cases):
+        if suffix == "7z" and py7zr is None or suffix.endswith("zst") and zstd is None and zstandard is None:
+            continue
+        archive = work_dir / "output" / f"{corpus_name}.{index}.{suffix}"
+        src = [str(each) for each in files] if len(files) > 1 else str(files[0])
+        compress_seconds, compress_rss = measure("compress", src, str(archive), kwargs)
+        output_size = get_size(archive)
+
+        decompress_kwargs = {"workers": kwargs["workers"]} if "workers" in kwargs and suffix == "zip" else {}
+        extract_dir = work_dir / "extract" / f"{corpus_name}.{index}"
+        decompress_seconds, decompress_rss = measure("decompress", str(archive), str(extract_dir),
+                                                     decompress_kwargs)
+
+        for operation, seconds, peak_rss in [("compress", compress_seconds, compress_rss),
+                                             ("decompress", decompress_seconds, decompress_rss)]:
+            result = {
+                "corpus": corpus_name,
+                "files": len(files),
+                "format": suffix,
+                "options": kwargs,
+                "operation": operation,
+                "input_bytes": input_size,
+                "output_bytes": output_size,
+                "ratio": output_size / input_size,
+                "seconds": seconds,
+                "mb_per_second": input_size / 1e6 / seconds,
+                "peak_rss_bytes": peak_rss
+            }
+            results.append(result)
+            print(f"{corpus_name:12} {suffix:8} {json.dumps(kwargs):18} {operation:10} "
+                  f"{result['mb_per_second']:9.2f} MB/s  ratio {result['ratio']:.3f}  "
+                  f"rss {(peak_rss or 0) / 1e6:8.1f} MB")
+        shutil.rmtree(extract_dir)
+        archive.unlink()
+    return results
+
+
+def case_key(result: dict) -> tuple:
+    return result["corpus"], result["format"], json.dumps(result["options"], sort_keys=True), result["operation"]
+
+
+def compare(baseline: list, results: list, threshold: float):
+    baseline = {case_key(result): result for result in baseline}
+    for result in results:
+        old = baseline.get(case_key(result))
+        if old is None:
+            continue
+        speed_change = result["mb_per_second"] / old["mb_per_second"] - 1
+        if speed_change < -threshold:
+            print(f"REGRESSION {' '.join(case_key(result))}: {old['mb_per_second']:.2f} -> "
+                  f"{result['mb_per_second']:.2f} MB/s ({speed_change:+.1%})")
+        if old["peak_rss_bytes"] and result["peak_rss_bytes"] \
+                and result["peak_rss_bytes"] / old["peak_rss_bytes"] - 1 > threshold:
+            print(f"REGRESSION {' '.join(case_key(result))}: peak RSS {old['peak_rss_bytes'] / 1e6:.1f} -> "
+                  f"{result['peak_rss_bytes'] / 1e6:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="The throughput and memory benchmark of ns_archive.")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the count of the tiny files")
+    parser.add_argument("--sizes", default="64M",
+                        help="the comma separated sizes of the huge files, e.g. 1M,100M,10G")
+    parser.add_argument("--output", default="bench_output.json", help="the JSON file to write the results")
+    parser.add_argument("--baseline", help="the JSON file of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="the relative change reported as regression")
+    args = parser.parse_args()
+
+    sizes = [size.strip() for size in args.sizes.split(",") if size.strip()]
+    for size in sizes:
+        parse_size(size)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run(args.scale, sizes, Path(work_dir))
+
+    report = {
+        "python": sys.version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": args.scale,
+        "sizes": sizes,
+        "results": results
+    }
+    with open(args.output, "w", encoding="utf-8") as output_file:
+        json.dump(report, output_file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            compare(json.load(baseline_file)["results"], results, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,258 @@
+import asyncio
+import bz2
+import gzip
+import io
+import lzma
+import os
+import tarfile
+import tempfile
+import threading
 import unittest
+import zipfile
+from pathlib import Path
+from unittest import mock
 
+import ns_archive
 from ns_archive import *
+from ns_archive import py7zr
 
 
 class NsArchiveTestCase(unittest.TestCase):
 
-    def test_compress(self):
-        compress()
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name)
+        # The members are named by the relative paths of the sources
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+        self.files = {
+            "src/a.txt": b"hello world\n" * 1000,
+            "src/b.bin": os.urandom(5000),
+            "src/sub/c.txt": b"c" * 10,
+            "src/sub/empty.txt": b""
+        }
+        for name, data in self.files.items():
+            Path(name).parent.mkdir(parents=True, exist_ok=True)
+            Path(name).write_bytes(data)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.temp_dir.cleanup()
+
+    def assertExtracted(self, dst_dir, names):
+        for name in names:
+            self.assertEqual((Path(dst_dir) / name).read_bytes(), self.files[name], name)
+
+    def test_choose_codec(self):
+        (self.root / "empty.txt").touch()
+        self.assertEqual(choose_codec(self.root / "empty.txt", max_seconds=1), ("gz", 1))
+        (self.root / "text.txt").write_bytes(b"hello world\n" * 100000)
+        codec, level = choose_codec(self.root / "text.txt", max_seconds=60, candidates=[("gz", 1), ("xz", 6)])
+        self.assertEqual((codec, level), ("xz", 6))
+
+    def test_parallel_codecs(self):
+        data = b"".join(i.to_bytes(4, "little") * 8 for i in range(50000)) + os.urandom(100000)
+        Path("big.bin").write_bytes(data)
+        for suffix, make, read in [("gz", make_gz, gzip.decompress), ("bz2", make_bz2, bz2.decompress),
+                                   ("xz", make_xz, lzma.decompress)]:
+            dst = f"big.bin.{suffix}"
+            make("big.bin", dst, workers=4, block_size=64 * 1024)
+            # The concatenated blocks are read back by the stock decoders
+            self.assertEqual(read(Path(dst).read_bytes()), data, suffix)
+            self.assertEqual(decompress(dst, f"out_{suffix}"), [str(self.root / f"out_{suffix}" / "big.bin")])
+            self.assertEqual((Path(f"out_{suffix}") / "big.bin").read_bytes(), data, suffix)
 
     def test_make_zip(self):
-        make_zip()
+        for workers in [1, 4]:
+            dst = f"src_{workers}.zip"
+            make_zip("src", dst, recursive=True, workers=workers)
+            with zipfile.ZipFile(dst) as zip_file:
+                self.assertIsNone(zip_file.testzip())
+                self.assertEqual(sorted(name for name in zip_file.namelist() if not name.endswith("/")),
+                                 sorted(self.files))
+            un_zip(dst, f"out_{workers}", workers=workers)
+            self.assertExtracted(f"out_{workers}", self.files)
+
+    def test_make_zip_pipelined_large_entry(self):
+        # The files over the limit are written by the writer thread directly
+        with mock.patch("ns_archive.PIPELINE_MAX_ENTRY_SIZE", 100):
+            make_zip("src", "src.zip", recursive=True, workers=4)
+        un_zip("src.zip", "out")
+        self.assertExtracted("out", self.files)
+
+        # The limit of each entry is lowered when there are more workers, 4 workers hold 9 entries at most
+        write = zipfile.ZipFile.write
+        with mock.patch("ns_archive.PIPELINE_MAX_BUFFER_SIZE", 9 * 1000), \
+                mock.patch.object(zipfile.ZipFile, "write", autospec=True, side_effect=write) as zip_write:
+            make_zip("src", "buffer.zip", recursive=True, workers=4)
+        self.assertEqual([str(call.args[1]) for call in zip_write.call_args_list], ["src/a.txt", "src/b.bin"])
+        un_zip("buffer.zip", "out_buffer")
+        self.assertExtracted("out_buffer", self.files)
+
+    def test_make_zip_incremental(self):
+        sources = [name for name in self.files]
+        make_zip(sources, "src.zip", incremental=True)
+        manifest_path = Path("src.zip.manifest.json")
+        self.assertTrue(manifest_path.is_file())
+
+        # Nothing changed, the zip file is not touched
+        mtime_ns = Path("src.zip").stat().st_mtime_ns
+        make_zip(sources, "src.zip", incremental=True)
+        self.assertEqual(Path("src.zip").stat().st_mtime_ns, mtime_ns)
+
+        # A new file is appended, and a changed file rebuilds the zip file
+        self.files["src/d.txt"] = b"new"
+        Path("src/d.txt").write_bytes(b"new")
+        make_zip(sources + ["src/d.txt"], "src.zip", incremental=True)
+        self.files["src/a.txt"] = b"changed"
+        Path("src/a.txt").write_bytes(b"changed")
+        make_zip(sources + ["src/d.txt"], "src.zip", incremental=True)
+        with zipfile.ZipFile("src.zip") as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.namelist(), sources + ["src/d.txt"])
+        un_zip("src.zip", "out")
+        self.assertExtracted("out", self.files)
+
+    def test_make_tar_incremental(self):
+        make_tar("src", "src.tar", incremental=True)
+        self.files["src/d.txt"] = b"new"
+        Path("src/d.txt").write_bytes(b"new")
+        make_tar("src", "src.tar", incremental=True)
+        with tarfile.open("src.tar") as tar_file:
+            self.assertEqual(tar_file.getnames().count("src/d.txt"), 1)
+        un_tar("src.tar", "out")
+        self.assertExtracted("out", self.files)
+
+    def test_tar_index(self):
+        # Restart the compressed stream after every member
+        with mock.patch("ns_archive.DEFAULT_CHECKPOINT_INTERVAL", 1024):
+            make_tar("src", "src.tar.gz", index=True)
+        self.assertTrue(Path("src.tar.gz.idx").is_file())
+        with tarfile.open("src.tar.gz") as tar_file:
+            self.assertIn("src/sub/c.txt", tar_file.getnames())
+
+        result = un_tar("src.tar.gz", "out", pattern=r"src/sub/", index=True)
+        self.assertEqual(result, [str(self.root / "out" / name) for name in ["src/sub/c.txt", "src/sub/empty.txt"]])
+        self.assertExtracted("out", ["src/sub/c.txt", "src/sub/empty.txt"])
+        self.assertFalse((self.root / "out" / "src" / "a.txt").exists())
+
+        # The index is built when it is missing
+        make_tar("src", "plain.tar.xz")
+        un_tar("plain.tar.xz", "out_plain", index=True)
+        self.assertTrue(Path("plain.tar.xz.idx").is_file())
+        self.assertExtracted("out_plain", self.files)
+
+    def test_tar_stream(self):
+        make_tar("src", "src.tar.bz2")
+        select = Selector(include_glob=["*.txt"], min_size=1)
+        result = un_tar("src.tar.bz2", "out", select=select, stream=True)
+        self.assertEqual(sorted(result), [str(self.root / "out" / name) for name in ["src/a.txt", "src/sub/c.txt"]])
+        self.assertExtracted("out", ["src/a.txt", "src/sub/c.txt"])
+
+        with open("src.tar.bz2", "rb") as input_file:
+            un_tar(io.BufferedReader(input_file), "out_pipe", compression="bz2")
+        self.assertExtracted("out_pipe", self.files)
+
+    def test_selector(self):
+        select = Selector(include=[r"src/.*\.txt"], exclude_glob=["*/sub/*"], max_size="1 KB")
+        self.assertTrue(select.matches("src/x.txt", 10))
+        self.assertFalse(select.matches("src/x.txt", 2000))
+        self.assertFalse(select.matches("src/x.txt"))
+        self.assertFalse(select.matches("src/sub/x.txt", 10))
+        self.assertFalse(select.matches("other/x.txt", 10))
+
+        select = Selector(include=[r"(?i)a"], include_glob=["*.bin"], min_mtime=100, max_mtime=200)
+        self.assertTrue(select.matches("A.TXT", mtime=150))
+        self.assertTrue(select.matches("x.bin", mtime=150))
+        self.assertFalse(select.matches("x.bin", mtime=250))
+        self.assertFalse(select.matches("x.txt", mtime=150))
+
+        make_zip("src", "src.zip", recursive=True)
+        with self.assertRaises(ValueError):
+            decompress("src.zip", "out", pattern="a", select=select)
+        result = un_zip("src.zip", "out", select=Selector(include_glob=["*.txt"], exclude=[r"src/sub"]))
+        self.assertEqual(result, [str(self.root / "out" / "src/a.txt")])
+
+    def test_open_archive(self):
+        make_zip("src", "src.zip", recursive=True)
+        make_zip("src", "stored.zip", recursive=True, store_only=True)
+        make_tar("src", "src.tar.gz")
+        make_gz("src/a.txt", "a.txt.gz")
+        for archive in ["src.zip", "stored.zip", "src.tar.gz"]:
+            members = {}
+            for member, stream in open_archive(archive):
+                self.assertEqual(member.is_dir, stream is None)
+                if stream is not None:
+                    members[member.name] = stream.read()
+                    self.assertEqual(member.size, len(members[member.name]))
+            self.assertEqual(members, self.files, archive)
+        members = [(member.name, stream.read()) for member, stream in open_archive("a.txt.gz")]
+        self.assertEqual(members, [("a.txt", self.files["src/a.txt"])])
+
+    @unittest.skipIf(py7zr is None, "The lib 'py7zr' is not installed")
+    def test_7z(self):
+        make_7z(list(self.files), "src.7z")
+        self.assertEqual({member.name: stream.read() for member, stream in open_archive("src.7z")
+                          if stream is not None}, self.files)
+        un_7z("src.7z", "out", pattern=r".*\.txt", workers=4)
+        self.assertExtracted("out", ["src/a.txt", "src/sub/c.txt", "src/sub/empty.txt"])
+        self.assertFalse((self.root / "out" / "src" / "b.bin").exists())
+
+    def test_progress(self):
+        events = []
+        make_zip(list(self.files), "src.zip", progress=events.append)
+        self.assertEqual([event.member for event in events], list(self.files))
+        self.assertEqual(events[-1].members_done, len(self.files))
+        self.assertEqual(events[-1].bytes_read, sum(len(data) for data in self.files.values()))
+
+        events = []
+        make_gz("src/a.txt", "a.txt.gz", buffer_size=1024, progress=events.append)
+        self.assertEqual(events[-1].member, "a.txt")
+        self.assertEqual(events[-1].bytes_read, len(self.files["src/a.txt"]))
+        self.assertEqual(events[-1].bytes_written, Path("a.txt.gz").stat().st_size)
+        self.assertGreater(len(events), len(self.files["src/a.txt"]) // 1024)
 
-    def test_make_7z(self):
-        make_7z()
+        events = []
+        un_tar(make_tar("src", "src.tar"), "out", progress=events.append)
+        self.assertEqual(events[-1].members_done, len(self.files) + 2)
 
-    def test_make_tar(self):
-        make_tar()
+    def test_async(self):
+        async def run():
+            events = []
+            await async_compress("src", "src.tar.gz", progress=events.append)
+            result = await async_decompress("src.tar.gz", "out", pattern=r"src/sub/")
+            members = [event.member async for event in async_decompress_iter("src.tar.gz", "out_iter")]
+            return events, result, members
 
-    def test_make_gz(self):
-        make_gz()
+        events, result, members = asyncio.run(run())
+        self.assertEqual(events[-1].members_done, len(self.files) + 2)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(sorted(members), sorted(list(self.files) + ["src", "src/sub"]))
+        self.assertExtracted("out_iter", self.files)
 
-    def test_decompress(self):
-        decompress()
+    def test_async_cancel(self):
+        track_zip_write = ns_archive._track_zip_write
+        resume = threading.Event()
 
-    def test_un_zip(self):
-        un_zip()
+        def wait_after_first_member(tracker, zip_file):
+            track_zip_write(tracker, zip_file)
+            if len(zip_file.filelist) == 1:
+                resume.wait(10)
 
-    def test_un_rar(self):
-        un_rar()
+        async def run():
+            loop = asyncio.get_running_loop()
+            task = None
 
-    def test_un_7z(self):
-        un_7z()
+            def on_progress(event):
+                # The task is cancelled before the operation goes on to the next member
+                task.cancel()
+                loop.call_soon(resume.set)
 
-    def test_un_tar(self):
-        un_tar()
+            task = asyncio.ensure_future(async_compress(list(self.files), "src.zip", progress=on_progress))
+            with self.assertRaises(asyncio.CancelledError):
+                await task
 
-    def test_un_gz(self):
-        un_gz()
+        with mock.patch("ns_archive._track_zip_write", side_effect=wait_after_first_member):
+            asyncio.run(run())
+        self.assertTrue(resume.is_set())
+        self.assertFalse(Path("src.zip").exists())
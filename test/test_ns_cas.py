@@ -0,0 +1,106 @@
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from ns_cas import *
+from ns_file import HashCache
+
+
+class NsCasTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name)
+        self.store = ContentStore(self.root / "cas")
+
+    def tearDown(self):
+        self.store.close()
+        self.temp_dir.cleanup()
+
+    def test_ingest(self):
+        for name in ["a", "b"]:
+            (self.root / name).write_bytes(b"same content")
+        digest = self.store.ingest(self.root / "a")
+        self.assertEqual(digest, hashlib.sha256(b"same content").hexdigest())
+        self.assertEqual(self.store.ingest(self.root / "b"), digest)
+        self.assertEqual(self.store.refcount(digest), 2)
+
+        object_path = self.store.path_of(digest)
+        self.assertEqual(object_path.relative_to(self.root / "cas" / "objects").parts,
+                         (digest[:2], digest[2:4], digest))
+        self.assertEqual(object_path.read_bytes(), b"same content")
+        self.assertEqual(object_path.stat().st_mode & 0o777, 0o444)
+        self.assertEqual(os.listdir(self.root / "cas" / "tmp"), [])
+
+        # The file is not copied when its cached digest is in the store
+        with HashCache(self.root / "cache.sqlite3") as cache:
+            self.assertEqual(self.store.ingest(self.root / "a", cache=cache), digest)
+            self.assertEqual(self.store.ingest(self.root / "a", cache=cache), digest)
+            self.assertEqual(cache.hits, 1)
+        self.assertEqual(self.store.refcount(digest), 4)
+        with self.assertRaises(IOError):
+            self.store.ingest(self.root / "missing")
+
+    def test_materialize(self):
+        (self.root / "a").write_bytes(b"content")
+        digest = self.store.ingest(self.root / "a")
+        for link in ["auto", "hardlink", "copy"]:
+            dst = self.root / "workspace" / link
+            self.assertEqual(self.store.materialize(digest, dst, link=link), str(dst.resolve()))
+            self.assertEqual(dst.read_bytes(), b"content")
+        self.assertEqual((self.root / "workspace" / "hardlink").stat().st_ino, self.store.path_of(digest).stat().st_ino)
+        self.assertEqual(self.store.refcount(digest), 4)
+
+        # The existing file is replaced
+        self.store.materialize(digest, self.root / "a", link="copy")
+        self.assertEqual((self.root / "a").read_bytes(), b"content")
+        with self.assertRaises(ValueError):
+            self.store.materialize(digest, self.root / "b", link="symlink")
+        with self.assertRaises(IOError):
+            self.store.materialize("0" * 64, self.root / "b")
+        self.assertEqual(self.store.refcount(digest), 5)
+
+    def test_gc(self):
+        for name in ["a", "b"]:
+            (self.root / name).write_bytes(name.encode() * 100)
+        digest_a = self.store.ingest(self.root / "a")
+        digest_b = self.store.ingest(self.root / "b")
+        self.store.retain(digest_b)
+        self.store.release(digest_a)
+        self.store.release(digest_b)
+        with self.assertRaises(ValueError):
+            self.store.release(digest_a)
+
+        self.assertEqual(self.store.gc(), (1, 100))
+        self.assertFalse(self.store.contains(digest_a))
+        self.assertTrue(self.store.contains(digest_b))
+        self.assertEqual(self.store.refcount(digest_b), 1)
+
+        # The orphan objects and temporary files are removed after the grace period
+        orphan_path = self.store.path_of("f" * 64)
+        orphan_path.parent.mkdir(parents=True)
+        orphan_path.write_bytes(b"orphan")
+        (self.root / "cas" / "tmp" / "stale.tmp").write_bytes(b"stale")
+        self.assertEqual(self.store.gc(), (0, 0))
+        self.assertEqual(self.store.gc(grace_seconds=-1), (1, 6))
+        self.assertFalse(orphan_path.exists())
+        self.assertEqual(os.listdir(self.root / "cas" / "tmp"), [])
+        self.assertTrue(self.store.contains(digest_b))
+
+    def test_concurrent_ingest(self):
+        (self.root / "a").write_bytes(b"shared")
+
+        def ingest():
+            with ContentStore(self.root / "cas") as store:
+                for _ in range(20):
+                    store.ingest(self.root / "a")
+
+        threads = [threading.Thread(target=ingest) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.store.refcount(hashlib.sha256(b"shared").hexdigest()), 80)
@@ -0,0 +1,367 @@
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+from pathlib import Path
+from unittest import mock
+
+import ns_file
+from ns_file import *
+from ns_file import ENCODING_SAMPLE_SIZE, SYNC_BLOCK_SIZE, SYNC_DELTA_THRESHOLD
+
+
+class NsFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_hash_file_multi(self):
+        data = os.urandom(300000)
+        (self.root / "data").write_bytes(data)
+        digests = hash_file_multi(str(self.root / "data"), ["md5", "sha256", "crc32"], 4096)
+        self.assertEqual(digests, {"md5": hashlib.md5(data).hexdigest(), "sha256": hashlib.sha256(data).hexdigest(),
+                                   "crc32": f"{zlib.crc32(data):08x}"})
+        self.assertEqual(hash_file(str(self.root / "data"), "sha256"), digests["sha256"])
+        (self.root / "empty").touch()
+        self.assertEqual(hash_file(str(self.root / "empty"), "md5"), hashlib.md5().hexdigest())
+        with self.assertRaises(ValueError):
+            hash_file_multi(str(self.root / "data"), [])
+
+    def test_hash_tree(self):
+        files = {"b": b"b", "a/2": b"a2", "a/1": b"a1", "c/d/e": b"e"}
+        for name, data in files.items():
+            (self.root / name).parent.mkdir(parents=True, exist_ok=True)
+            (self.root / name).write_bytes(data)
+        (self.root / "link").symlink_to(self.root / "b")
+
+        results = list(hash_tree(self.root, ["md5", "sha1"], workers=3))
+        self.assertEqual([path for path, _ in results],
+                         [str(self.root / name) for name in ["a/1", "a/2", "b", "c/d/e"]])
+        for path, digests in results:
+            data = files[os.path.relpath(path, self.root)]
+            self.assertEqual(digests, {"md5": hashlib.md5(data).hexdigest(), "sha1": hashlib.sha1(data).hexdigest()})
+        self.assertEqual(list(hash_tree(self.root / "b", "md5")),
+                         [(str(self.root / "b"), {"md5": hashlib.md5(b"b").hexdigest()})])
+        with self.assertRaises(IOError):
+            hash_tree(self.root / "missing", "md5")
+
+    def test_hash_cache(self):
+        data_path = self.root / "data"
+        data_path.write_bytes(b"hello")
+        cache_path = self.root / "cache.sqlite3"
+        with HashCache(cache_path) as cache:
+            self.assertEqual(hash_file(str(data_path), "md5", cache=cache), hashlib.md5(b"hello").hexdigest())
+            self.assertEqual(hash_file(str(data_path), "md5", cache=cache), hashlib.md5(b"hello").hexdigest())
+            self.assertEqual((cache.hits, cache.misses, cache.saved_bytes), (1, 1, 5))
+
+        # The cache is persistent, and a changed file is hashed again
+        with HashCache(cache_path) as cache:
+            with mock.patch("ns_file._hash_opened_file") as hash_opened_file:
+                hash_file(str(data_path), "md5", cache=cache)
+                hash_opened_file.assert_not_called()
+            data_path.write_bytes(b"changed")
+            os.utime(data_path, ns=(0, 0))
+            self.assertEqual(hash_file(str(data_path), "md5", cache=cache), hashlib.md5(b"changed").hexdigest())
+
+        # The least recently used entries are evicted
+        with HashCache(self.root / "small.sqlite3", max_entries=2) as cache:
+            for name in ["a", "b", "c"]:
+                (self.root / name).write_bytes(name.encode())
+                hash_file(str(self.root / name), "sha1", cache=cache)
+            self.assertIsNone(cache.get(os.stat(self.root / "a"), "sha1"))
+            self.assertEqual(cache.get(os.stat(self.root / "c"), "sha1"), hashlib.sha1(b"c").hexdigest())
+        with self.assertRaises(ValueError):
+            HashCache(cache_path, max_entries=0)
+
+    def test_detect_encoding(self):
+        text = "编码 encoding\n" * 100
+        for name, data, encoding in [("ascii.txt", b"plain ascii\n", "utf-8"),
+                                     ("u8.txt", text.encode("utf-8"), "utf-8"),
+                                     ("u8_bom.txt", text.encode("utf-8-sig"), "utf-8-sig"),
+                                     ("u16.txt", text.encode("utf-16"), "utf-16")]:
+            (self.root / name).write_bytes(data)
+            self.assertEqual(detect_encoding(self.root / name), encoding, name)
+            with smart_open(self.root / name) as f:
+                self.assertEqual(f.read(), data.decode(encoding), name)
+
+        # A multibyte character cut by the end of the sample is still utf-8
+        sample_path = self.root / "sample.txt"
+        sample_path.write_bytes(("a" + "编" * ENCODING_SAMPLE_SIZE).encode("utf-8"))
+        self.assertEqual(detect_encoding(sample_path), "utf-8")
+
+        # The cached result is dropped when the file is changed
+        sample_path.write_bytes(b"\xef\xbb\xbfchanged")
+        self.assertEqual(detect_encoding(sample_path), "utf-8-sig")
+
+    def test_transcode(self):
+        text = "转码 transcode\n" * 1000
+        (self.root / "gbk.txt").write_bytes(text.encode("gbk"))
+        # The small chunks split the multibyte characters
+        transcode(self.root / "gbk.txt", self.root / "out" / "u8.txt", source="gbk", chunk_size=7)
+        self.assertEqual((self.root / "out" / "u8.txt").read_text(encoding="utf-8"), text)
+
+        # The same file, and the source encoding is detected
+        transcode(self.root / "out" / "u8.txt", self.root / "out" / "u8.txt", "utf-16")
+        self.assertEqual((self.root / "out" / "u8.txt").read_bytes(), text.encode("utf-16"))
+
+        for name in ["a.txt", "b.txt"]:
+            (self.root / name).write_bytes(f"{name} {text}".encode("utf-8"))
+        results = transcode([self.root / "a.txt", self.root / "b.txt"], self.root / "gbk", "gbk", workers=2)
+        self.assertEqual(results, [str(self.root / "gbk" / name) for name in ["a.txt", "b.txt"]])
+        for name in ["a.txt", "b.txt"]:
+            self.assertEqual((self.root / "gbk" / name).read_bytes(), f"{name} {text}".encode("gbk"))
+        self.assertEqual(sorted(os.listdir(self.root / "gbk")), ["a.txt", "b.txt"])
+        (self.root / "sub").mkdir()
+        (self.root / "sub" / "a.txt").write_text("a")
+        with self.assertRaises(ValueError):
+            transcode([self.root / "a.txt", self.root / "sub" / "a.txt"], self.root / "same", workers=2)
+        self.assertFalse((self.root / "same").exists())
+
+        with self.assertRaises(LookupError):
+            transcode(self.root / "a.txt", self.root / "c.txt", "no-such-codec")
+        with self.assertRaises(UnicodeDecodeError):
+            transcode(self.root / "gbk.txt", self.root / "c.txt", source="utf-8")
+        self.assertFalse((self.root / "c.txt").exists())
+        self.assertFalse((self.root / "c.txt.tmp").exists())
+
+    def test_bulk_copy(self):
+        src_dir = self.root / "src"
+        (src_dir / "sub" / "deep").mkdir(parents=True)
+        for name in ["a", "sub/b", "sub/deep/c"]:
+            (src_dir / name).write_text(name)
+        (src_dir / "link").symlink_to("a")
+        os.chmod(src_dir / "a", 0o600)
+        os.utime(src_dir / "sub" / "b", (1000000000, 1000000000))
+        (self.root / "single").write_text("single")
+
+        results = bulk_copy([src_dir, self.root / "single"], self.root / "dst", workers=4, metadata=True)
+        self.assertEqual(results, [str(self.root / "dst" / "src"), str(self.root / "dst" / "single")])
+        dst_dir = self.root / "dst" / "src"
+        for name in ["a", "sub/b", "sub/deep/c"]:
+            self.assertEqual((dst_dir / name).read_text(), name)
+        self.assertEqual(os.readlink(dst_dir / "link"), "a")
+        self.assertEqual((dst_dir / "a").stat().st_mode & 0o777, 0o600)
+        self.assertEqual((dst_dir / "sub" / "b").stat().st_mtime, 1000000000)
+        self.assertEqual((self.root / "dst" / "single").read_text(), "single")
+        with self.assertRaises(IOError):
+            bulk_copy([self.root / "missing"], self.root / "dst")
+
+    def test_bulk_move(self):
+        src_dir = self.root / "src"
+        (src_dir / "sub").mkdir(parents=True)
+        (src_dir / "sub" / "a").write_text("a")
+        (self.root / "single").write_text("single")
+
+        results = bulk_move([src_dir, self.root / "single"], self.root / "dst")
+        self.assertEqual(results, [str(self.root / "dst" / "src"), str(self.root / "dst" / "single")])
+        self.assertEqual((self.root / "dst" / "src" / "sub" / "a").read_text(), "a")
+        self.assertEqual((self.root / "dst" / "single").read_text(), "single")
+        self.assertFalse(src_dir.exists())
+        self.assertFalse((self.root / "single").exists())
+
+        # The trees on another filesystem are copied and deleted
+        (self.root / "other").mkdir()
+        (self.root / "other" / "a").write_text("other")
+        with mock.patch("os.rename", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")):
+            bulk_move([self.root / "other"], self.root / "dst")
+        self.assertEqual((self.root / "dst" / "other" / "a").read_text(), "other")
+        self.assertFalse((self.root / "other").exists())
+        (self.root / "single").write_text("single")
+        with self.assertRaises(IOError):
+            bulk_move([self.root / "single"], self.root / "dst")
+
+    def test_copy_same_file(self):
+        src_dir = self.root / "c"
+        src_dir.mkdir()
+        for name in ["a.txt", "b.txt"]:
+            (src_dir / name).write_text(name)
+
+        with self.assertRaises(shutil.SameFileError):
+            copy(src_dir / "a.txt", src_dir)
+        with self.assertRaises(shutil.SameFileError):
+            bulk_copy([src_dir / "b.txt"], src_dir)
+        self.assertEqual((src_dir / "a.txt").read_text(), "a.txt")
+        self.assertEqual((src_dir / "b.txt").read_text(), "b.txt")
+
+    def test_sync_file_into_dir(self):
+        src = self.root / "u8.txt"
+        src.write_text("hello")
+        dst_dir = self.root / "important_dir"
+        (dst_dir / "keep").mkdir(parents=True)
+        (dst_dir / "keep" / "data").write_text("data")
+
+        result = sync(src, dst_dir)
+        self.assertEqual(result, SyncResult(1, 0, 5, 0))
+        self.assertEqual((dst_dir / "u8.txt").read_text(), "hello")
+        self.assertEqual((dst_dir / "keep" / "data").read_text(), "data")
+
+    def test_sync_never_replaces_dir(self):
+        src_dir = self.root / "src"
+        src_dir.mkdir()
+        (src_dir / "name").write_text("file")
+        dst_dir = self.root / "dst"
+        (dst_dir / "name").mkdir(parents=True)
+        (dst_dir / "name" / "data").write_text("data")
+
+        with self.assertRaises(IOError):
+            sync(src_dir, dst_dir)
+        self.assertEqual((dst_dir / "name" / "data").read_text(), "data")
+
+    def test_sync_block_delta(self):
+        src_dir = self.root / "src"
+        src_dir.mkdir()
+        data = bytearray(os.urandom(SYNC_DELTA_THRESHOLD * 2))
+        (src_dir / "big").write_bytes(data)
+        (src_dir / "small").write_bytes(b"small")
+        dst_dir = self.root / "dst"
+
+        result = sync(src_dir, dst_dir)
+        self.assertEqual(result, SyncResult(2, 0, len(data) + 5, 0))
+        result = sync(src_dir, dst_dir)
+        self.assertEqual(result, SyncResult(0, 2, 0, len(data) + 5))
+
+        # Only the changed block is written
+        data[SYNC_BLOCK_SIZE + 10:SYNC_BLOCK_SIZE + 20] = os.urandom(10)
+        (src_dir / "big").write_bytes(data)
+        result = sync(src_dir, dst_dir)
+        self.assertEqual(result, SyncResult(1, 1, SYNC_BLOCK_SIZE, len(data) - SYNC_BLOCK_SIZE + 5))
+        self.assertEqual((dst_dir / "big").read_bytes(), data)
+
+        # The shrunk file is truncated
+        (src_dir / "big").write_bytes(data[:SYNC_DELTA_THRESHOLD])
+        result = sync(src_dir, dst_dir)
+        self.assertEqual(result.files_transferred, 1)
+        self.assertEqual((dst_dir / "big").read_bytes(), data[:SYNC_DELTA_THRESHOLD])
+
+    def test_sync_hard_linked(self):
+        src_dir = self.root / "src"
+        src_dir.mkdir()
+        dst_dir = self.root / "dst"
+        dst_dir.mkdir()
+        data = os.urandom(SYNC_DELTA_THRESHOLD * 2)
+        for name in ["big", "small"]:
+            (dst_dir / name).write_bytes(data)
+            os.link(dst_dir / name, self.root / f"{name}_link")
+            (src_dir / name).write_bytes(data[::-1])
+
+        sync(src_dir, dst_dir)
+        for name in ["big", "small"]:
+            self.assertEqual((dst_dir / name).read_bytes(), data[::-1])
+            self.assertEqual((self.root / f"{name}_link").read_bytes(), data)
+
+    def test_sync_delete(self):
+        src_dir = self.root / "src"
+        src_dir.mkdir()
+        (src_dir / "a").write_text("a")
+        dst_dir = self.root / "dst"
+        (dst_dir / "extra").mkdir(parents=True)
+
+        sync(src_dir, dst_dir)
+        self.assertTrue((dst_dir / "extra").exists())
+        sync(src_dir, dst_dir, delete=True)
+        self.assertEqual(sorted(os.listdir(dst_dir)), ["a"])
+
+    def test_get_content_type(self):
+        files = {
+            "png_no_suffix": b"\x89PNG\r\n\x1a\n" + bytes(16),
+            "wrong_suffix.txt": b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n",
+            "doc.docx": b"PK\x03\x04" + bytes(16),
+            "data.bin.txt": b"PK\x03\x04" + bytes(16),
+            "countries.csv": b"MZ,Mozambique\nNZ,New Zealand\n",
+            "notes.txt": b"BZh is the magic of bzip2\n",
+            "id3.md": b"ID3 tags\n",
+            "plain": b"hello\n",
+            "binary": b"\x00\x01\x02",
+            "empty": b""
+        }
+        for name, data in files.items():
+            (self.root / name).write_bytes(data)
+        expected = ["image/png", "application/pdf",
+                    "application/vnd.openxmlformats-officedocument.wordprocessingml.document", "application/zip",
+                    "text/csv", "text/plain", "text/markdown", "text/plain", "application/octet-stream", None]
+        results = list(get_content_types([self.root / name for name in files], workers=4))
+        self.assertEqual([content_type for _, content_type in results], expected)
+        self.assertEqual(get_content_type(self.root / "png_no_suffix"), None)
+        self.assertEqual(get_content_type(self.root / "png_no_suffix", sniff=True), "image/png")
+
+        # The files disappeared after the listing are skipped and reported
+        errors = []
+        paths = [self.root / "plain", self.root / "missing", self.root / "binary"]
+        results = list(get_content_types(paths, on_error=errors.append))
+        self.assertEqual(results, [(str(self.root / "plain"), "text/plain"),
+                                   (str(self.root / "binary"), "application/octet-stream")])
+        self.assertEqual(len(errors), 1)
+        self.assertIn(str(self.root / "missing"), str(errors[0]))
+        with self.assertRaises(IOError):
+            get_content_type(self.root / "missing", sniff=True)
+
+    def test_delete(self):
+        target = self.root / "target"
+        for i in range(3):
+            (target / f"dir_{i}" / "sub").mkdir(parents=True)
+            for j in range(2100):
+                (target / f"dir_{i}" / str(j)).touch()
+        outside = self.root / "outside"
+        outside.mkdir()
+        (outside / "keep").touch()
+        (target / "link").symlink_to(outside)
+
+        delete(target, workers=4)
+        self.assertFalse(target.exists())
+        self.assertTrue((outside / "keep").exists())
+
+        (target / "sub").mkdir(parents=True)
+        (target / "sub" / "file").touch()
+        future = delete(target, deferred=True)
+        self.assertFalse(target.exists())
+        future.result()
+        self.assertEqual(os.listdir(self.root), ["outside"])
+        with self.assertRaises(IOError):
+            delete(target)
+
+    def test_find_duplicates(self):
+        big = os.urandom(100000)
+        for name, data in [("a", big), ("b", big), ("c", big), ("d", b"small"), ("e", b"small"), ("f", b"other")]:
+            (self.root / name).write_bytes(data)
+        groups = list(find_duplicates(self.root))
+        self.assertEqual(groups, [[str(self.root / "a"), str(self.root / "b"), str(self.root / "c")],
+                                  [str(self.root / "d"), str(self.root / "e")]])
+
+        # The files disappeared after the walk are skipped and reported
+        errors = []
+        groups = find_duplicates(self.root, on_error=errors.append)
+        (self.root / "b").unlink()
+        (self.root / "e").unlink()
+        self.assertEqual(list(groups), [[str(self.root / "a"), str(self.root / "c")]])
+        self.assertEqual(sorted(error.filename for error in errors), [str(self.root / "b"), str(self.root / "e")])
+
+    def test_find_duplicates_hardlink(self):
+        big = os.urandom(100000)
+        for name in ["a", "b", "c"]:
+            (self.root / name).write_bytes(big)
+        groups = list(find_duplicates(self.root, hardlink=True))
+        self.assertEqual(len(groups), 1)
+        self.assertEqual((self.root / "a").stat().st_ino, (self.root / "c").stat().st_ino)
+
+        # The kept file is rewritten after it is hashed, so the duplicates are not replaced by links to it
+        for name in ["d", "e"]:
+            (self.root / name).write_bytes(big[::-1])
+        hash_file = ns_file.hash_file
+
+        def rewrite_kept_file(path, *args, **kwargs):
+            digest = hash_file(path, *args, **kwargs)
+            if path.endswith("e"):
+                (self.root / "d").write_bytes(os.urandom(len(big)))
+            return digest
+
+        with mock.patch("ns_file.hash_file", side_effect=rewrite_kept_file):
+            list(find_duplicates([self.root / "d", self.root / "e"], hardlink=True))
+        self.assertEqual((self.root / "e").read_bytes(), big[::-1])
+        self.assertNotEqual((self.root / "d").stat().st_ino, (self.root / "e").stat().st_ino)